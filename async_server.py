@@ -0,0 +1,314 @@
+"""
+asyncio backend for ControlServer
+
+`AsyncControlServer` serves socket.io with python-socketio's AsyncServer on
+aiohttp, in an asyncio event loop on its own thread. Frames are decoded in a
+thread or process pool, so neither the socket I/O nor JPEG decoding waits for
+the drivers. The callbacks (handle_connect, handle_telemetry,
+handle_disconnect) still run one greenthread per frame on the eventlet hub
+of the thread that called start(), exactly as with ControlServer. The Tk
+status window, batched prediction and the inference worker pool keep working
+unchanged, and drivers do not need to be thread-safe.
+
+    frame -> [asyncio] recv -> [decode pool] decode -> [hub] callbacks
+          -> send_control -> [asyncio] emit
+
+Select it with `create_server(backend='asyncio')` or `--backend asyncio`.
+Requires aiohttp.
+"""
+__author__ = 'Thomas Antony'
+
+import os
+import time
+import queue
+import base64
+import asyncio
+import threading
+import multiprocessing
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor
+
+import cv2
+import numpy as np
+import socketio
+from aiohttp import web
+
+import eventlet
+from eventlet.hubs import trampoline
+
+from server import ControlServer, Session, decode_frame
+
+
+def dummy_telemetry():
+    """
+    Raw telemetry with a black frame.
+    """
+    jpeg = cv2.imencode('.jpg', np.zeros((160, 320, 3), dtype=np.uint8))[1]
+    return {'steering_angle': '0', 'throttle': '0', 'speed': '0',
+            'image': base64.b64encode(jpeg.tobytes()).decode('ascii')}
+
+
+def warm_up_decoder(decode_mode):
+    """
+    Initializer of the decode worker processes. Decoding one frame imports
+    and initializes the image libraries.
+    """
+    decode_frame(dummy_telemetry(), decode_mode)
+
+
+class HubExecutor(object):
+    """
+    Runs functions in greenthreads on the eventlet hub of the thread that
+    calls run(), on behalf of other threads. Callers are woken up through a
+    pipe that the hub waits on, as in process_pool.py.
+    """
+    def __init__(self):
+        self.calls = queue.Queue()
+        self.read_fd, self.write_fd = os.pipe()
+        os.set_blocking(self.read_fd, False)
+        os.set_blocking(self.write_fd, False)
+
+    def submit(self, fn, *args):
+        """
+        Thread-safe. Returns a concurrent.futures.Future of fn(*args).
+        """
+        future = Future()
+        self.calls.put((future, fn, args))
+        try:
+            os.write(self.write_fd, b'.')
+        except BlockingIOError:
+            pass # Pipe is full, so the hub is already due to wake up
+        return future
+
+    def run(self):
+        """
+        Serves calls forever. Other greenthreads keep running meanwhile.
+        """
+        while True:
+            trampoline(self.read_fd, read=True)
+            try:
+                os.read(self.read_fd, 4096)
+            except BlockingIOError:
+                pass
+            while True:
+                try:
+                    future, fn, args = self.calls.get_nowait()
+                except queue.Empty:
+                    break
+                eventlet.spawn_n(self.call, future, fn, args)
+
+    def call(self, future, fn, args):
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            result = fn(*args)
+        except Exception as e:
+            future.set_exception(e)
+        else:
+            future.set_result(result)
+
+
+class SocketBridge(socketio.AsyncNamespace):
+    """
+    Forwards socket.io events to AsyncControlServer.
+    """
+    def __init__(self, server):
+        super().__init__()
+        self.control_srv = server
+
+    async def on_connect(self, sid, environ):
+        await self.control_srv.handle_connect_async(sid, environ)
+
+    async def on_telemetry(self, sid, data):
+        await self.control_srv.handle_telemetry_async(sid, data)
+
+    async def on_disconnect(self, sid):
+        await self.control_srv.handle_disconnect_async(sid)
+
+
+class AsyncControlServer(ControlServer):
+
+    def __init__(self, decode_executor='thread', decode_workers=2, **options):
+        """
+        decode_executor : 'thread'  - frames are decoded in a thread pool
+                          'process' - frames are decoded in worker processes,
+                                      which costs a copy of every image
+        decode_workers  : size of the decode pool
+
+        Other options are passed on to ControlServer.
+        """
+        if options.get('pipeline'):
+            raise ValueError('The asyncio backend decodes frames in its own pool, '
+                             'use the frame pipeline with the eventlet backend')
+        super().__init__(**options)
+        if decode_executor not in ('thread', 'process'):
+            raise ValueError('Unknown decode executor: %s' % decode_executor)
+        self.decode_executor = decode_executor
+        self.decode_workers = decode_workers
+
+        self.loop = None
+        self.hub = None
+        self.decoder = None
+        self.startup_error = None
+        # Owned by the asyncio thread. Metrics and sessions are only changed
+        # on the hub.
+        self.frame_locks = {} # Keep the frames of a session in order
+        self.slots = {}       # Newest frame of each session, 'latest' scheduling
+        self.received = 0     # Frames received and dropped since the last
+        self.dropped = 0      # frame handed to the hub
+
+    def start(self):
+        """
+        Starts the asyncio server thread and serves callbacks on this thread.
+        Does not return.
+        """
+        if self.decode_executor == 'process':
+            self.decoder = ProcessPoolExecutor(
+                self.decode_workers, mp_context=multiprocessing.get_context('spawn'),
+                initializer=warm_up_decoder, initargs=(self.decode_mode,))
+            # Start the workers, and let them import the decoders, now rather
+            # than on the first frames
+            data = dummy_telemetry()
+            for future in [self.decoder.submit(decode_frame, data, self.decode_mode)
+                           for _ in range(self.decode_workers)]:
+                future.result()
+        else:
+            self.decoder = ThreadPoolExecutor(self.decode_workers,
+                                              thread_name_prefix='decode')
+
+        self.hub = HubExecutor()
+        started = threading.Event()
+        thread = threading.Thread(target=self.run_loop, name='asyncio-server',
+                                  args=(started,))
+        thread.daemon = True
+        thread.start()
+        started.wait()
+        if self.startup_error is not None:
+            raise self.startup_error
+        self.hub.run()
+
+    def run_loop(self, started):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+        self.sio = socketio.AsyncServer(async_mode='aiohttp')
+        self.sio.register_namespace(SocketBridge(self))
+        self.web_app = web.Application()
+        self.sio.attach(self.web_app)
+        self.web_app.router.add_get('/metrics', self.serve_metrics_async)
+        self.web_app.router.add_get('/profile', self.serve_profile_async)
+
+        try:
+            runner = web.AppRunner(self.web_app)
+            self.loop.run_until_complete(runner.setup())
+            self.loop.run_until_complete(web.TCPSite(runner, port=4567).start())
+        except Exception as e:
+            self.startup_error = e # Raised by start()
+            return
+        finally:
+            started.set()
+        self.loop.run_forever()
+
+    def close(self):
+        super().close()
+        if self.decoder is not None:
+            self.decoder.shutdown(wait=False)
+
+    async def serve_metrics_async(self, request):
+        return web.json_response(await self.on_hub(self.metrics_snapshot))
+
+    async def serve_profile_async(self, request):
+        try:
+            seconds = float(request.query.get('seconds', 10.))
+        except ValueError:
+            seconds = 10.
+        # On the hub, so that cProfile sees the callbacks
+        response, status = await self.on_hub(
+            self.profile_request, seconds, request.query.get('mode', 'sample'))
+        return web.json_response(response, status=status)
+
+    def on_hub(self, fn, *args):
+        """
+        Awaitable result of fn(*args) run on the eventlet hub.
+        """
+        return asyncio.wrap_future(self.hub.submit(fn, *args))
+
+    async def handle_connect_async(self, sid, environ):
+        self.frame_locks[sid] = asyncio.Lock()
+        await self.on_hub(self.on_connect, sid, environ)
+
+    async def handle_disconnect_async(self, sid):
+        self.frame_locks.pop(sid, None)
+        self.slots.pop(sid, None)
+        await self.on_hub(self.on_disconnect, sid)
+
+    async def handle_telemetry_async(self, sid, data):
+        received = time.time()
+        self.received += 1
+        if self.recorder is not None:
+            self.recorder.record(data, received)
+
+        if self.scheduling == 'latest':
+            slot = self.slots.get(sid)
+            if slot is None:
+                slot = self.slots[sid] = Session(sid)
+            if slot.frame is not None:
+                slot.dropped += 1
+                self.dropped += 1
+            slot.frame = (data, received)
+            if not slot.busy:
+                slot.busy = True
+                await self.drain_slot(slot)
+        else:
+            await self.process_frame(sid, data, received)
+
+    async def drain_slot(self, slot):
+        try:
+            while slot.frame is not None:
+                data, received = slot.frame
+                slot.frame = None
+                await self.process_frame(slot.sid, data, received)
+                slot.processed += 1
+        finally:
+            slot.busy = False
+
+    async def process_frame(self, sid, data, received):
+        lock = self.frame_locks.get(sid)
+        if lock is None:
+            lock = self.frame_locks[sid] = asyncio.Lock()
+
+        # Frames are handed to the hub in the order they arrived. The next
+        # frame of the session is decoded while the callbacks handle this one.
+        async with lock:
+            t0 = time.perf_counter()
+            telemetry, base64_time, image_time = await self.loop.run_in_executor(
+                self.decoder, decode_frame, data, self.decode_mode)
+            decode_time = time.perf_counter() - t0
+
+            # Frame counts since the last frame are handed over with this one
+            counts = (self.received, self.dropped)
+            self.received = self.dropped = 0
+            telemetry['sid'] = sid
+            done = self.on_hub(self.handle_decoded, sid, telemetry, received, t0,
+                               (decode_time, base64_time, image_time), counts)
+        await done
+
+    def handle_decoded(self, sid, telemetry, received, t0, timings, counts):
+        """
+        Runs on the hub, which owns the metrics and sessions. Records the
+        accounting of the asyncio thread and hands the frame to the callbacks.
+        """
+        decode_time, base64_time, image_time = timings
+        received_count, dropped_count = counts
+        self.metrics.increment('frames_received', received_count)
+        self.metrics.increment('frames_dropped', dropped_count)
+        self.metrics.observe('base64_decode', base64_time)
+        self.metrics.observe('image_decode', image_time)
+        self.metrics.observe('decode_wait', decode_time - base64_time - image_time)
+        self.dispatch_telemetry(self.get_session(sid), telemetry, received, t0, decode_time)
+
+    def emit_steer(self, data, sid):
+        if sid is None:
+            coro = self.sio.emit("steer", data=data, skip_sid=True)
+        else:
+            coro = self.sio.emit("steer", data=data, room=sid)
+        asyncio.run_coroutine_threadsafe(coro, self.loop)
@@ -0,0 +1,111 @@
+"""
+Batch augmentation of live-training samples
+
+All transforms work on a whole batch of preprocessed YUV images (N, 66, 200, 3)
+at once:
+
+- horizontal flip with negated steering angle
+- brightness jitter, scaling the Y (luma) channel
+- horizontal shift with a matching steering correction
+
+`AugmentationProducer` runs them in a background thread between the live
+trainer and the training worker, so augmentation adds no time to the
+telemetry handler.
+"""
+__author__ = 'Thomas Antony'
+
+import queue
+import threading
+
+import numpy as np
+
+
+def flip(images, labels, mask):
+    """
+    Mirrors the images selected by the boolean mask and negates their labels.
+    """
+    images = images.copy()
+    labels = labels.copy()
+    images[mask] = images[mask][:, :, ::-1]
+    labels[mask] = -labels[mask]
+    return images, labels
+
+
+def jitter_brightness(images, factors):
+    """
+    Scales the Y channel of every image by its factor.
+    """
+    images = images.copy()
+    y = images[..., 0].astype(np.float32)
+    y *= factors[:, None, None]
+    np.clip(y, 0, 255, out=y)
+    images[..., 0] = y
+    return images
+
+
+def shift(images, labels, dx, steering_per_pixel):
+    """
+    Shifts every image horizontally by dx pixels, repeating the edge columns,
+    and corrects the steering angle by dx*steering_per_pixel.
+    """
+    n, h, w, c = images.shape
+    cols = np.clip(np.arange(w)[None, :] - dx[:, None], 0, w - 1)
+    index = np.broadcast_to(cols[:, None, :, None], images.shape)
+    return (np.take_along_axis(images, index, axis=2),
+            labels + dx*steering_per_pixel)
+
+
+def augment_batch(images, labels, copies=2, max_shift=20, steering_per_pixel=0.004,
+                  brightness_range=(0.6, 1.4), rng=np.random):
+    """
+    Returns the original batch followed by `copies` randomly augmented
+    versions of it.
+    """
+    labels = np.asarray(labels, dtype=np.float32)
+    n = len(images)
+    out_images = [images]
+    out_labels = [labels]
+    for i in range(copies):
+        x, y = flip(images, labels, rng.rand(n) < 0.5)
+        x = jitter_brightness(x, rng.uniform(brightness_range[0], brightness_range[1], n).astype(np.float32))
+        x, y = shift(x, y, rng.randint(-max_shift, max_shift + 1, n), steering_per_pixel)
+        out_images.append(x)
+        out_labels.append(y.astype(np.float32))
+    return np.concatenate(out_images), np.concatenate(out_labels)
+
+
+class AugmentationProducer(object):
+    def __init__(self, trainer, copies=2, max_queue=4, **augment_options):
+        """
+        trainer : object with submit(X, y), e.g. a TrainingWorker
+        copies  : augmented copies added per sample
+        """
+        self.trainer = trainer
+        self.copies = copies
+        self.augment_options = augment_options
+
+        self.batches = queue.Queue(maxsize=max_queue)
+        self.dropped_batches = 0
+        self.produced_batches = 0
+
+        self.thread = threading.Thread(target=self.run, name='augmentation')
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def submit(self, X, y):
+        """
+        Queues a raw batch for augmentation. Never blocks, if augmentation is
+        falling behind the batch is dropped.
+        """
+        try:
+            self.batches.put_nowait((X, y))
+        except queue.Full:
+            self.dropped_batches += 1
+
+    def run(self):
+        while True:
+            X, y = self.batches.get()
+            self.trainer.submit(*augment_batch(X, y, self.copies, **self.augment_options))
+            self.produced_batches += 1
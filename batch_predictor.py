@@ -0,0 +1,75 @@
+"""
+Cross-session batching of single-frame predictions
+
+Used by hybrid_driver.py --batch-window with any engine. Does not import
+Keras, so it works with the NumPy engine when TensorFlow is not installed.
+"""
+__author__ = 'Thomas Antony'
+
+import numpy as np
+import eventlet
+from eventlet.event import Event
+
+
+class BatchPredictor(object):
+    """
+    Collects single-frame predictions from concurrent greenthreads (one per
+    simulator session) and runs them through the engine as one batch.
+
+    A batch is run as soon as every active session has submitted a frame,
+    when max_batch frames are waiting, or `window` seconds after the first
+    frame arrived, whichever comes first.
+    """
+    def __init__(self, engine, window=0.005, max_batch=32, sessions=None):
+        """
+        sessions : sessions() -> number of active sessions
+        """
+        self.engine = engine
+        self.window = window
+        self.max_batch = max_batch
+        self.sessions = sessions
+
+        self.pending = []
+        self.timer = None
+
+        # Statistics
+        self.batches = 0
+        self.frames = 0
+
+    def predict(self, image):
+        """
+        Blocks the calling greenthread until the batch containing the image
+        has been run, then returns its output as a float.
+        """
+        done = Event()
+        self.pending.append((image, done))
+
+        expected = self.max_batch
+        if self.sessions is not None:
+            expected = max(1, min(expected, self.sessions()))
+
+        if len(self.pending) >= expected:
+            self.flush()
+        elif self.timer is None:
+            self.timer = eventlet.spawn_after(self.window, self.flush)
+        return done.wait()
+
+    def flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        pending, self.pending = self.pending, []
+        if not pending:
+            return
+
+        try:
+            outputs = self.engine.predict_batch(np.stack([image for image, done in pending]))
+        except Exception as e:
+            for image, done in pending:
+                done.send_exception(e)
+            return
+
+        self.batches += 1
+        self.frames += len(pending)
+        for (image, done), y in zip(pending, outputs):
+            done.send(float(y))
@@ -0,0 +1,268 @@
+"""
+Micro-benchmarks for each stage of the frame pipeline
+
+Times every stage separately on synthetic or recorded 320x160 JPEG frames,
+without the simulator or a display:
+
+- decode:     ControlServer frame decoding (PIL and fast) and the whole
+              on_telemetry call with a no-op driver
+- preprocess: preprocess_input in drive.py and LiveTrainer
+- predict:    NumPy engine, model.predict and InferenceEngine, single frames
+              and batches
+- train:      one LiveTrainer.train_model step
+
+Stages that need Keras or a model are skipped when they are not available.
+
+    python benchmark.py --model model_5.json --json baseline.json
+    python benchmark.py --model model_5.json --baseline baseline.json
+
+Every stage is timed in --repeats passes over the frames, one pass of each
+stage per round. With --baseline, the median of the pass medians of every
+stage is compared with the stored results, so a single pass slowed down by
+other processes does not decide the result. A stage is
+reported as a regression when it is slower by more than --threshold plus the
+spread of its pass medians in either run, so noisy stages need a larger
+slowdown. Regressions, and stages of the baseline that did not run this time,
+make the exit status 1.
+"""
+__author__ = 'Thomas Antony'
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+
+from functools import partial
+
+import numpy as np
+
+from replay import latency_stats, ReplaySink
+from fake_sim import synthetic_frames, recorded_frames
+
+
+numpy_stage_names = ('predict_numpy', 'predict_batch_numpy')
+keras_stage_names = ('predict_keras', 'predict_engine', 'predict_batch_engine', 'train_step')
+
+
+def time_pass(fn, inputs):
+    """
+    Calls fn(x) for every input and returns the latencies in seconds.
+    """
+    latencies = np.empty(len(inputs))
+    for i, x in enumerate(inputs):
+        t0 = time.perf_counter()
+        fn(x)
+        latencies[i] = time.perf_counter() - t0
+    return latencies
+
+
+def stage_stats(passes):
+    """
+    latency_stats over all passes, plus the median of the pass medians
+    ('median_p50', ms) and the spread of the pass medians relative to it.
+    """
+    passes = np.asarray(passes)
+    stats = latency_stats(passes.ravel())
+    p50s = np.median(passes, axis=1)*1000
+    median = float(np.median(p50s))
+    stats['median_p50'] = median
+    stats['spread'] = float((p50s.max() - p50s.min())/median) if median > 0 else 0.
+    stats['repeats'] = len(p50s)
+    return stats
+
+
+class NullDriver(object):
+    def handle_telemetry(self, data):
+        pass
+
+
+class Benchmark(object):
+    def __init__(self, frames, batch_size=16, repeats=5):
+        self.frames = frames
+        self.batch_size = batch_size
+        self.repeats = repeats
+        self.stages = {}
+        self.skipped = {}
+        self.tasks = [] # (name, fn, inputs), timed by measure()
+
+    def run(self, name, fn, inputs, warmup=5):
+        """
+        Warms up a stage and queues it for measure().
+        """
+        for x in inputs[:warmup]:
+            fn(x)
+        self.tasks.append((name, fn, inputs))
+
+    def measure(self):
+        """
+        Times one pass of every queued stage per round, for `repeats` rounds.
+        Interleaving the stages spreads a slow period of the machine over all
+        of them instead of one stage's passes.
+        """
+        passes = dict((name, []) for name, fn, inputs in self.tasks)
+        for r in range(self.repeats):
+            for name, fn, inputs in self.tasks:
+                passes[name].append(time_pass(fn, inputs))
+        for name, fn, inputs in self.tasks:
+            self.stages[name] = lat = stage_stats(passes[name])
+            print('%-22s p50 %8.3f  p95 %8.3f  mean %8.3f ms  spread %3.0f%%' %
+                  (name, lat['median_p50'], lat['p95'], lat['mean'], lat['spread']*100))
+        self.tasks = []
+
+    def skip(self, names, reason):
+        for name in names:
+            self.skipped[name] = reason
+            print('%-22s skipped: %s' % (name, reason))
+
+    def batches(self, images):
+        n = self.batch_size
+        return [images[i:i + n] for i in range(0, len(images) - n + 1, n)] or [images]
+
+    def decode_stages(self):
+        from server import ControlServer
+
+        images = {}
+        for mode in ('pil', 'fast'):
+            srv = ControlServer(decode_mode=mode)
+            session = srv.get_session('benchmark')
+            self.run('decode_' + mode, partial(srv.decode_telemetry, session=session), self.frames)
+            images[mode] = [np.array(srv.decode_telemetry(data, session)['image'])
+                            for data in self.frames]
+
+        srv = ControlServer(decode_mode='fast')
+        srv.sio = ReplaySink()
+        srv.register_callback(NullDriver())
+        self.run('on_telemetry', lambda data: srv.on_telemetry('benchmark', data), self.frames)
+        return images
+
+    def preprocess_stages(self, images):
+        from live_trainer import LiveTrainer
+        import drive
+
+        self.run('preprocess_drive', drive.preprocess_input, images['pil'])
+        self.run('preprocess_trainer', LiveTrainer.preprocess_input, images['fast'])
+        return np.stack([LiveTrainer.preprocess_input(img) for img in images['fast']])
+
+    def numpy_stages(self, model_path, x):
+        from numpy_engine import NumpyEngine
+
+        engine = NumpyEngine.from_json(model_path)
+        engine.warmup()
+        self.run('predict_numpy', engine.predict, x)
+        self.run('predict_batch_numpy', engine.predict_batch, self.batches(x))
+
+    def keras_stages(self, model_path, x, labels):
+        from replay import make_driver
+
+        driver = make_driver('trainer', model_path)
+        model, engine = driver.model, driver.engine
+        self.run('predict_keras', lambda img: model.predict(img[None]), x)
+        self.run('predict_engine', engine.predict, x)
+        self.run('predict_batch_engine', engine.predict_batch, self.batches(x))
+
+        batches = [(X, labels[:len(X)]) for X in self.batches(x)]
+        self.run('train_step', lambda b: driver.train_model(model, b[0], b[1]), batches)
+
+    def results(self):
+        return {'frames': len(self.frames),
+                'batch_size': self.batch_size,
+                'repeats': self.repeats,
+                'python': sys.version.split()[0],
+                'machine': platform.machine(),
+                'stages': self.stages,
+                'skipped': self.skipped}
+
+
+def compare(results, baseline, threshold):
+    """
+    Returns [(stage, baseline p50, current p50, ratio)] for stages whose
+    median pass median grew by more than threshold plus the larger spread of
+    the two runs. Stages of the baseline that are missing from the results are
+    returned with current p50 and ratio None. Baselines stored before stages
+    were repeated are compared by their p50.
+    """
+    regressions = []
+    for name, base in sorted(baseline['stages'].items()):
+        base_p50 = base.get('median_p50', base['p50'])
+        lat = results['stages'].get(name)
+        if lat is None:
+            regressions.append((name, base_p50, None, None))
+            print('%-22s %8.3f ->  missing     MISSING (%s)' %
+                  (name, base_p50, results['skipped'].get(name, 'not run')))
+            continue
+        if base_p50 <= 0:
+            continue
+        p50 = lat.get('median_p50', lat['p50'])
+        ratio = p50/base_p50
+        allowed = threshold + max(base.get('spread', 0.), lat.get('spread', 0.))
+        flag = ''
+        if ratio > 1 + allowed:
+            regressions.append((name, base_p50, p50, ratio))
+            flag = '  REGRESSION'
+        print('%-22s %8.3f -> %8.3f ms (%+.0f%%, allowed %+.0f%%)%s' %
+              (name, base_p50, p50, (ratio - 1)*100, allowed*100, flag))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the frame pipeline')
+    parser.add_argument('--model', type=str, default=None,
+        help='Model definition json, enables the predict and train stages.')
+    parser.add_argument('--log', type=str, default=None,
+        help='Telemetry log to take frames from instead of synthetic frames.')
+    parser.add_argument('--frames', type=int, default=200,
+        help='Number of frames per stage.')
+    parser.add_argument('--batch', type=int, default=16,
+        help='Batch size of the batched stages.')
+    parser.add_argument('--json', type=str, default=None,
+        help='Write the results to this file.')
+    parser.add_argument('--baseline', type=str, default=None,
+        help='Compare with results stored with --json.')
+    parser.add_argument('--threshold', type=float, default=0.2,
+        help='Relative slowdown of a stage reported as a regression, on top of the spread of its passes.')
+    parser.add_argument('--repeats', type=int, default=5,
+        help='Passes over the frames per stage.')
+    args = parser.parse_args()
+
+    if args.log:
+        frames = recorded_frames(args.log, args.frames)
+    else:
+        frames = synthetic_frames(args.frames)
+
+    bench = Benchmark(frames, args.batch, args.repeats)
+    images = bench.decode_stages()
+    x = bench.preprocess_stages(images)
+    labels = np.array([float(data['steering_angle']) for data in frames], dtype=np.float32)
+
+    if args.model is None:
+        bench.skip(numpy_stage_names + keras_stage_names, 'no --model given')
+    else:
+        try:
+            bench.numpy_stages(args.model, x)
+        except (IOError, OSError, ValueError, KeyError) as e:
+            bench.skip(numpy_stage_names, str(e))
+        try:
+            import keras
+        except ImportError as e:
+            bench.skip(keras_stage_names, str(e))
+        else:
+            bench.keras_stages(args.model, x, labels)
+
+    bench.measure()
+    results = bench.results()
+    results['source'] = args.log or 'synthetic'
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        print('\nCompared with %s:' % args.baseline)
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print('%d stage(s) regressed by more than their allowed slowdown or did not run' %
+                  len(regressions))
+            sys.exit(1)
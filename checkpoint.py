@@ -0,0 +1,219 @@
+"""
+Asynchronous, versioned checkpoints for the live trainer
+
+`CheckpointManager.save` is called from the training thread after every
+batch. At most once every `interval` seconds (or `every_steps` batches) it
+copies the model weights into memory and hands the copy to a writer thread,
+which writes them in the same HDF5 layout as Keras' `save_weights`, so the
+files can be loaded with `model.load_weights`.
+
+Every file is written to a temporary name and then renamed into place, so a
+crash never leaves a half-written checkpoint behind. For each checkpoint the
+writer keeps
+
+    checkpoint-000042.h5     versioned weights (the newest `keep` are kept)
+    checkpoint-000042.json   step, loss and time of the checkpoint
+
+and replaces `checkpoint.h5`/`checkpoint.json` with a copy of the newest one.
+"""
+__author__ = 'Thomas Antony'
+
+import os
+import re
+import json
+import time
+import shutil
+import threading
+
+import h5py
+
+
+def snapshot_weights(model):
+    """
+    Returns [(layer name, [(weight name, value), ...]), ...] for the model.
+    """
+    snapshot = []
+    for layer in model.layers:
+        values = layer.get_weights()
+        names = [getattr(w, 'name', None) or 'param_%d' % i
+                 for i, w in enumerate(layer.weights)]
+        snapshot.append((layer.name, list(zip(names, values))))
+    return snapshot
+
+
+def write_weights(path, snapshot):
+    """
+    Writes a weight snapshot in the layout used by Keras' save_weights.
+    """
+    with h5py.File(path, 'w') as f:
+        f.attrs['layer_names'] = [name.encode('utf8') for name, weights in snapshot]
+        for layer_name, weights in snapshot:
+            g = f.create_group(layer_name)
+            g.attrs['weight_names'] = [name.encode('utf8') for name, value in weights]
+            for name, value in weights:
+                g.create_dataset(name, data=value)
+
+
+def replace_file(src, dst):
+    """
+    Atomically replaces dst with a copy of src.
+    """
+    tmp = '%s.%d.tmp' % (dst, os.getpid())
+    shutil.copyfile(src, tmp)
+    os.replace(tmp, dst)
+
+
+def write_json(path, data):
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(data, f, indent=2)
+    os.replace(tmp, path)
+
+
+class CheckpointManager(object):
+    def __init__(self, path='./checkpoint.h5', interval=10., every_steps=None,
+                 keep=5, metrics=None):
+        """
+        path        : latest checkpoint, versioned files are written next to it
+        interval    : minimum seconds between checkpoints (None to disable)
+        every_steps : checkpoint after this many steps (None to disable)
+        keep        : number of versioned checkpoints kept on disk
+        metrics     : optional Metrics that write times are recorded in
+        """
+        self.path = path
+        self.interval = interval
+        self.every_steps = every_steps
+        self.keep = keep
+        self.metrics = metrics
+
+        base, self.ext = os.path.splitext(path)
+        self.directory, self.name = os.path.split(base)
+        self.directory = self.directory or '.'
+        self.version_pattern = re.compile(r'^%s-(\d+)%s$' % (re.escape(self.name), re.escape(self.ext)))
+
+        self.step = 0
+        self.last_step = 0
+        self.last_time = time.time()
+
+        self.condition = threading.Condition()
+        self.pending = None
+        self.writing = False
+
+        # Statistics
+        self.written = 0
+        self.skipped = 0 # Snapshots replaced before the writer got to them
+
+        self.thread = threading.Thread(target=self.run, name='checkpoint-writer')
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def version_path(self, step, ext=None):
+        return os.path.join(self.directory, '%s-%06d%s' % (self.name, step, ext or self.ext))
+
+    def due(self):
+        if self.interval is not None and time.time() - self.last_time >= self.interval:
+            return True
+        if self.every_steps is not None and self.step - self.last_step >= self.every_steps:
+            return True
+        return False
+
+    def save(self, model, loss=None, force=False):
+        """
+        Counts a training step and, if a checkpoint is due, queues a snapshot
+        of the model weights for writing. Call from the thread that trains the
+        model. Returns True if a snapshot was queued.
+        """
+        self.step += 1
+        if not (force or self.due()):
+            return False
+        self.checkpoint(model, loss)
+        return True
+
+    def save_final(self, model, loss=None):
+        """
+        Queues a snapshot of the model weights if it was trained since the
+        last checkpoint, e.g. before exiting. Call flush() afterwards to wait
+        for it. Returns True if a snapshot was queued.
+        """
+        if self.step == self.last_step:
+            return False
+        self.checkpoint(model, loss)
+        return True
+
+    def checkpoint(self, model, loss):
+        snapshot = snapshot_weights(model)
+        info = {'step': self.step, 'loss': None if loss is None else float(loss),
+                'time': time.time()}
+        self.last_step = self.step
+        self.last_time = info['time']
+
+        with self.condition:
+            if self.pending is not None:
+                self.skipped += 1
+            self.pending = (snapshot, info)
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.pending is None:
+                    self.condition.wait()
+                snapshot, info = self.pending
+                self.pending = None
+                self.writing = True
+            try:
+                self.write(snapshot, info)
+            except Exception as e:
+                print('Could not write checkpoint: %s' % e)
+            with self.condition:
+                self.writing = False
+                self.condition.notify_all()
+
+    def write(self, snapshot, info):
+        t0 = time.perf_counter()
+        path = self.version_path(info['step'])
+        info['file'] = os.path.basename(path)
+
+        tmp = '%s.%d.tmp' % (path, os.getpid())
+        write_weights(tmp, snapshot)
+        os.replace(tmp, path)
+        write_json(self.version_path(info['step'], '.json'), info)
+
+        # Latest checkpoint, e.g. for drivers watching checkpoint.h5
+        replace_file(path, self.path)
+        write_json(os.path.splitext(self.path)[0] + '.json', info)
+
+        self.prune()
+        self.written += 1
+        if self.metrics is not None:
+            self.metrics.observe('checkpoint_write', time.perf_counter() - t0)
+
+    def versions(self):
+        """
+        Returns the steps of the versioned checkpoints on disk, oldest first.
+        """
+        steps = []
+        for filename in os.listdir(self.directory):
+            match = self.version_pattern.match(filename)
+            if match:
+                steps.append(int(match.group(1)))
+        return sorted(steps)
+
+    def prune(self):
+        for step in self.versions()[:-self.keep]:
+            for ext in (self.ext, '.json'):
+                try:
+                    os.remove(self.version_path(step, ext))
+                except OSError:
+                    pass
+
+    def flush(self):
+        """
+        Waits until all queued snapshots have been written.
+        """
+        with self.condition:
+            while self.pending is not None or self.writing:
+                self.condition.wait()
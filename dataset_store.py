@@ -0,0 +1,240 @@
+"""
+Append-only on-disk store for data collected during live training
+
+A dataset is a directory of fixed-size shards. Every shard is a set of `.npy`
+files (images, labels, speeds, throttles) that are written through memory maps,
+plus an `index.json` that records how many samples each shard holds. Only
+samples counted in the index are visible to readers, and the index is replaced
+atomically after the shard data has been flushed.
+
+Images are stored exactly as the drivers feed them to the model. The index
+records their dtype and format, which for model_5 is float32 YUV from
+preprocess_input. Datasets written before this was recorded stored the YUV
+frames as uint8, which wrapped the negative U/V values around, and cannot be
+opened.
+"""
+__author__ = 'Thomas Antony'
+
+import os
+import json
+import time
+import queue
+import threading
+
+import numpy as np
+
+index_filename = 'index.json'
+fields = ('images', 'labels', 'speeds', 'throttles')
+image_format = 'yuv' # preprocess_input output, cv2.cvtColor on float32 RGB
+
+
+def shard_path(path, field, shard):
+    return os.path.join(path, '%s-%05d.npy' % (field, shard))
+
+
+def read_index(path):
+    with open(os.path.join(path, index_filename), 'r') as f:
+        index = json.load(f)
+    if 'image_dtype' not in index:
+        raise ValueError('%s was written with wrapped uint8 images and cannot be '
+                         'used. Move it away and collect the data again.' % path)
+    return index
+
+
+class DatasetWriter(object):
+    def __init__(self, path, shard_size=4096, image_shape=(66, 200, 3),
+                 image_dtype=np.float32, flush_interval=5.0):
+        """
+        path           : dataset directory, created if needed. Appends to an
+                         existing dataset of the same image dtype.
+        shard_size     : number of samples per shard
+        image_dtype    : dtype of the images, that of preprocess_input's output
+        flush_interval : seconds between flushes of shard data and index
+        """
+        self.path = path
+        self.flush_interval = flush_interval
+        os.makedirs(path, exist_ok=True)
+
+        self.image_dtype = np.dtype(image_dtype)
+        if os.path.exists(os.path.join(path, index_filename)):
+            self.index = read_index(path)
+            if self.index['image_dtype'] != self.image_dtype.name:
+                raise ValueError('%s holds %s images, not %s' %
+                                 (path, self.index['image_dtype'], self.image_dtype.name))
+        else:
+            self.index = {'shard_size': shard_size,
+                          'image_shape': list(image_shape),
+                          'image_dtype': self.image_dtype.name,
+                          'image_format': image_format,
+                          'shards': []}
+
+        self.shard = None # memory maps of the shard being written
+        self.batches = queue.Queue()
+        self.last_flush = time.time()
+        self.dirty = False
+
+        self.thread = threading.Thread(target=self.run, name='dataset-writer')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def __len__(self):
+        return sum(s['size'] for s in self.index['shards'])
+
+    def append(self, images, labels, speeds, throttles):
+        """
+        Queues a batch for writing. Returns immediately, the arrays must not
+        be modified by the caller afterwards. Raises TypeError if the images
+        cannot be stored without losing values.
+        """
+        images = np.asarray(images)
+        if not np.can_cast(images.dtype, self.image_dtype, 'same_kind'):
+            raise TypeError('Cannot store %s images in a %s dataset' %
+                            (images.dtype, self.image_dtype))
+        self.batches.put((images, labels, speeds, throttles))
+
+    def flush(self):
+        """
+        Blocks until every queued batch is on disk and visible to readers.
+        """
+        self.batches.put(None)
+        self.batches.join()
+
+    def close(self):
+        self.flush()
+
+    def run(self):
+        while True:
+            try:
+                batch = self.batches.get(timeout=self.flush_interval)
+            except queue.Empty:
+                self.sync()
+                continue
+
+            try:
+                if batch is None:
+                    self.sync()
+                else:
+                    self.write(*batch)
+                    if time.time() - self.last_flush > self.flush_interval:
+                        self.sync()
+            finally:
+                self.batches.task_done()
+
+    def open_shard(self):
+        n = len(self.index['shards'])
+        shard_size = self.index['shard_size']
+        image_shape = tuple(self.index['image_shape'])
+        specs = {'images': (self.image_dtype, (shard_size,) + image_shape),
+                 'labels': (np.float32, (shard_size,)),
+                 'speeds': (np.float32, (shard_size,)),
+                 'throttles': (np.float32, (shard_size,))}
+
+        self.shard = {}
+        for field in fields:
+            dtype, shape = specs[field]
+            self.shard[field] = np.lib.format.open_memmap(
+                shard_path(self.path, field, n), mode='w+', dtype=dtype, shape=shape)
+        self.index['shards'].append({'shard': n, 'size': 0})
+
+    def write(self, *arrays):
+        n_samples = len(arrays[0])
+        written = 0
+        while written < n_samples:
+            if self.shard is None:
+                if self.index['shards'] and \
+                        self.index['shards'][-1]['size'] < self.index['shard_size']:
+                    self.reopen_shard()
+                else:
+                    self.open_shard()
+
+            info = self.index['shards'][-1]
+            start = info['size']
+            count = min(n_samples - written, self.index['shard_size'] - start)
+            for field, array in zip(fields, arrays):
+                np.copyto(self.shard[field][start:start + count],
+                          array[written:written + count], casting='same_kind')
+            info['size'] += count
+            written += count
+            self.dirty = True
+
+            if info['size'] == self.index['shard_size']:
+                self.sync()
+                self.shard = None
+
+    def reopen_shard(self):
+        """
+        Continues writing a partially filled shard from a previous session.
+        """
+        n = self.index['shards'][-1]['shard']
+        self.shard = dict((field, np.load(shard_path(self.path, field, n), mmap_mode='r+'))
+                          for field in fields)
+
+    def sync(self):
+        if not self.dirty:
+            return
+        if self.shard is not None:
+            for array in self.shard.values():
+                array.flush()
+
+        tmp = os.path.join(self.path, index_filename + '.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(self.index, f)
+        os.replace(tmp, os.path.join(self.path, index_filename))
+
+        self.dirty = False
+        self.last_flush = time.time()
+
+
+class DatasetReader(object):
+    def __init__(self, path):
+        self.path = path
+        self.refresh()
+
+    def refresh(self):
+        """
+        Re-reads the index to pick up samples written since opening.
+        """
+        self.index = read_index(self.path)
+        self.sizes = [s['size'] for s in self.index['shards']]
+        self.offsets = np.cumsum([0] + self.sizes)
+        self.cache = {}
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def shard(self, i):
+        """
+        Returns memory-mapped (images, labels, speeds, throttles) of shard i,
+        trimmed to the samples that have been committed.
+        """
+        if i not in self.cache:
+            n = self.index['shards'][i]['shard']
+            self.cache[i] = tuple(
+                np.load(shard_path(self.path, field, n), mmap_mode='r')[:self.sizes[i]]
+                for field in fields)
+        return self.cache[i]
+
+    def read(self, start, stop):
+        """
+        Returns (images, labels, speeds, throttles) for samples [start, stop).
+        Ranges that fall within one shard are returned as memory-mapped views
+        without copying, ranges spanning shards are concatenated.
+        """
+        stop = min(stop, len(self))
+        parts = []
+        while start < stop:
+            i = int(np.searchsorted(self.offsets, start, side='right')) - 1
+            local = start - self.offsets[i]
+            count = min(stop - start, self.sizes[i] - local)
+            parts.append(tuple(a[local:local + count] for a in self.shard(i)))
+            start += count
+
+        if len(parts) == 1:
+            return parts[0]
+        if not parts:
+            image_shape = tuple(self.index['image_shape'])
+            return (np.empty((0,) + image_shape, dtype=self.index['image_dtype']),
+                    np.empty(0, dtype=np.float32),
+                    np.empty(0, dtype=np.float32),
+                    np.empty(0, dtype=np.float32))
+        return tuple(np.concatenate(p) for p in zip(*parts))
@@ -1,4 +1,5 @@
 import argparse
+import atexit
 import base64
 import json
 
@@ -13,27 +14,81 @@ from flask import Flask, render_template
 from io import BytesIO
 import cv2
 
-from keras.models import model_from_json
-from keras.preprocessing.image import img_to_array
+from functools import partial
 
-import tensorflow as tf
-from tensorflow.python.ops import control_flow_ops
-tf.python.control_flow_ops = control_flow_ops
+from model_loader import ModelLoader, weights_path
+from weight_watcher import WeightWatcher, weight_shapes
+from drive_log import DriveLog
 
 
 sio = socketio.Server()
 app = Flask(__name__)
 model = None
+engine = None
+watcher = None  # Reloads weights while driving when --watch is given
+reloads = 0
+drive_log = None  # Per-frame binary log when --drive-log is given
 
 def roi(img): # For model 5
-    img = img[60:140,40:280]
+    img = img[60:140,40:280].astype(np.float32, copy=False)
     return cv2.resize(img, (200, 66))
 
 def preprocess_input(img):
-    return roi(cv2.cvtColor(img, cv2.COLOR_RGB2YUV))
+    # Cropped and resized before the color conversion, so that only the small
+    # ROI is converted to float32. cvtColor offsets U and V by 128 for uint8
+    # input but by 0.5 for float32, so the conversion has to see float32 for
+    # both decode modes to give the model the same input.
+    return cv2.cvtColor(roi(img), cv2.COLOR_RGB2YUV)
+
+def load_model(path):
+    # Keras and TensorFlow are imported here so the server can start first
+    from keras.models import model_from_json
+
+    import tensorflow as tf
+    from tensorflow.python.ops import control_flow_ops
+    tf.python.control_flow_ops = control_flow_ops
+
+    with open(path, 'r') as jfile:
+        # model = model_from_json(json.load(jfile))
+        model = model_from_json(jfile.read())
+
+    model.compile("adam", "mse")
+    weights_file = path.replace('json', 'h5')
+    model.load_weights(weights_file)
+    return model
+
+def set_model(loaded_model):
+    global model
+    from inference import InferenceEngine
+
+    new_engine = InferenceEngine(loaded_model)
+    new_engine.warmup()
+    model = loaded_model
+    set_engine(new_engine)
+
+def set_engine(new_engine):
+    global engine
+    engine = new_engine
+
+def reload_weights():
+    global reloads
+    weights = watcher.take()
+    if weights is None:
+        return
+
+    start = time.time()
+    engine.set_weights(weights)
+    reloads += 1
+    print('Reloaded weights (%d) in %0.1f ms' % (reloads, (time.time() - start)*1000))
 
 @sio.on('telemetry')
 def telemetry(sid, data):
+    received = time.time()
+    if engine is None:
+        # Model is still loading, hold the car still
+        send_control(0, 0)
+        return
+
     # The current steering angle of the car
     steering_angle = data["steering_angle"]
     # The current throttle of the car
@@ -46,10 +101,12 @@ def telemetry(sid, data):
 
     # model >= 5
     x = np.asarray(image, dtype=np.float32)
+    decoded = time.time()
     image_array = preprocess_input(x)
-    transformed_image_array = image_array[None, :, :, :]
+    preprocessed = time.time()
 
-    steering_angle = float(model.predict(transformed_image_array, batch_size=1))
+    steering_angle = engine.predict(image_array)
+    predicted = time.time()
 
     speed = float(speed)
 
@@ -74,8 +131,19 @@ def telemetry(sid, data):
     throttle = max(throttle_min, throttle)
     # else don't change from previous
     print(steering_angle, throttle)
+    send_start = time.time()
     send_control(steering_angle, throttle)
 
+    if drive_log is not None:
+        done = time.time()
+        drive_log.record(received, sid, 'auto', False, steering_angle, steering_angle,
+                         throttle, speed, decoded - received, preprocessed - decoded,
+                         predicted - preprocessed, done - send_start, done - received)
+
+    # Swap in a new checkpoint before the next frame
+    if watcher is not None:
+        reload_weights()
+
 
 @sio.on('connect')
 def connect(sid, environ):
@@ -94,14 +162,36 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Remote Driving')
     parser.add_argument('model', type=str,
     help='Path to model definition json. Model weights should be on the same path.')
+    parser.add_argument('--workers', type=int, default=0,
+    help='Run the model in this many worker processes instead of in-process.')
+    parser.add_argument('--engine', choices=['keras', 'numpy'], default='keras',
+    help='Run the model with Keras or the pure-NumPy engine.')
+    parser.add_argument('--watch', type=str, default=None,
+    help='Reload the weights from this file (e.g. checkpoint.h5) whenever it changes.')
+    parser.add_argument('--drive-log', type=str, default=None,
+    help='Write a binary record of every frame to this file (see drive_log.py).')
     args = parser.parse_args()
-    with open(args.model, 'r') as jfile:
-        # model = model_from_json(json.load(jfile))
-        model = model_from_json(jfile.read())
+    if args.engine != 'keras' and args.workers > 0:
+        parser.error('--workers is only supported with the keras engine')
 
-    model.compile("adam", "mse")
-    weights_file = args.model.replace('json', 'h5')
-    model.load_weights(weights_file)
+    if args.drive_log:
+        drive_log = DriveLog(args.drive_log)
+        atexit.register(drive_log.close)
+
+    if args.watch:
+        watcher = WeightWatcher(args.watch, weight_shapes(weights_path(args.model))).start()
+
+    # Load the model in the background while the server accepts connections
+    load_fn = partial(load_model, args.model)
+
+    if args.engine == 'numpy':
+        from numpy_engine import load_engine
+        ModelLoader(partial(load_engine, args.model), set_engine).start()
+    elif args.workers > 0:
+        from process_pool import InferencePool
+        ModelLoader(partial(InferencePool, load_fn, args.workers), set_engine).start()
+    else:
+        ModelLoader(load_fn, set_model).start()
 
     # wrap Flask application with engineio's middleware
     app = socketio.Middleware(sio, app)
@@ -0,0 +1,162 @@
+"""
+Compact binary log with one record per frame
+
+A drive log is a short header followed by fixed-width little-endian records:
+
+    time                float64  time.time() the frame was received
+    session             uint16   index of the simulator session
+    mode                uint8    0 manual, 1 autonomous
+    training            uint8    1 if the frame was used for live training
+    predicted_steering  float32  model output, NaN if the model was not run
+    steering            float32  steering angle sent to the simulator
+    throttle            float32  throttle sent to the simulator
+    speed               float32  speed reported by the simulator
+    decode_ms ... total_ms  float32  time spent in each stage, NaN if skipped
+
+Records are collected in a preallocated NumPy buffer and written by a
+background thread, so logging a frame is a single row assignment.
+`load_drive_log` memory-maps the file, and every field is available as a
+NumPy array without reading the log into memory:
+
+    log = load_drive_log('session.drive')
+    log['total_ms'].mean(), (log['mode'] == 1).mean()
+
+The session ids are stored in `<log>.json` next to the log.
+"""
+__author__ = 'Thomas Antony'
+
+import json
+import time
+import queue
+import threading
+
+import numpy as np
+
+magic = b'SDCDRV1\n'
+
+record_dtype = np.dtype([
+    ('time', '<f8'),
+    ('session', '<u2'),
+    ('mode', 'u1'),
+    ('training', 'u1'),
+    ('predicted_steering', '<f4'),
+    ('steering', '<f4'),
+    ('throttle', '<f4'),
+    ('speed', '<f4'),
+    ('decode_ms', '<f4'),
+    ('preprocess_ms', '<f4'),
+    ('predict_ms', '<f4'),
+    ('send_ms', '<f4'),
+    ('total_ms', '<f4'),
+])
+
+modes = {'manual': 0, 'auto': 1}
+
+
+def header():
+    """
+    Magic, then the record layout as length-prefixed json, padded to 8 bytes.
+    """
+    layout = json.dumps(record_dtype.descr).encode('ascii')
+    data = magic + np.uint32(len(layout)).tobytes() + layout
+    return data + b' '*(-len(data) % 8)
+
+
+class DriveLog(object):
+    def __init__(self, path, buffer_size=1024, flush_interval=2.0):
+        """
+        path           : log file, overwritten if it exists
+        buffer_size    : records collected before they are handed to the writer
+        flush_interval : maximum seconds a record waits before being written
+        """
+        self.path = path
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+
+        self.file = open(path, 'wb')
+        self.file.write(header())
+
+        self.buffer = np.zeros(buffer_size, dtype=record_dtype)
+        self.n = 0
+        self.last_flush = time.time()
+        self.sessions = {}
+        self.records = 0
+
+        self.buffers = queue.Queue()
+        self.thread = threading.Thread(target=self.run, name='drive-log')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def session_index(self, sid):
+        if sid not in self.sessions:
+            self.sessions[sid] = len(self.sessions)
+            self.buffers.put(list(self.sessions)) # Update the session list
+        return self.sessions[sid]
+
+    def record(self, received, sid, mode, training, predicted_steering, steering,
+               throttle, speed, decode, preprocess, predict, send, total):
+        """
+        Logs one frame. Latencies are in seconds, None for skipped stages.
+        """
+        nan = float('nan')
+        self.buffer[self.n] = (
+            received, self.session_index(sid), modes.get(mode, 255), bool(training),
+            nan if predicted_steering is None else predicted_steering,
+            steering, throttle, speed,
+            nan if decode is None else decode*1000,
+            nan if preprocess is None else preprocess*1000,
+            nan if predict is None else predict*1000,
+            nan if send is None else send*1000,
+            nan if total is None else total*1000)
+        self.n += 1
+        self.records += 1
+
+        if self.n == self.buffer_size or time.time() - self.last_flush > self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """
+        Hands the collected records to the writer thread.
+        """
+        if self.n:
+            self.buffers.put(self.buffer[:self.n])
+            self.buffer = np.zeros(self.buffer_size, dtype=record_dtype)
+            self.n = 0
+        self.last_flush = time.time()
+
+    def close(self):
+        self.flush()
+        self.buffers.put(None)
+        self.thread.join()
+
+    def run(self):
+        while True:
+            item = self.buffers.get()
+            if item is None:
+                break
+            if isinstance(item, list):
+                with open(self.path + '.json', 'w') as f:
+                    json.dump({'sessions': item}, f, indent=2)
+            else:
+                self.file.write(item.tobytes())
+                self.file.flush()
+        self.file.close()
+
+
+def load_drive_log(path):
+    """
+    Returns the records of a drive log as a read-only memory-mapped
+    structured array. Fields are accessed as columns, e.g. log['speed'].
+    """
+    with open(path, 'rb') as f:
+        if f.read(len(magic)) != magic:
+            raise ValueError('%s is not a drive log' % path)
+        length = int(np.frombuffer(f.read(4), dtype=np.uint32)[0])
+        dtype = np.dtype([tuple(field) for field in json.loads(f.read(length).decode('ascii'))])
+        offset = len(magic) + 4 + length
+        offset += -offset % 8
+        f.seek(0, 2)
+        count = (f.tell() - offset)//dtype.itemsize # Ignore a partial last record
+    if count == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=(count,))
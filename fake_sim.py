@@ -0,0 +1,170 @@
+"""
+Stand-in for the Udacity simulator, for load-testing the control server
+
+Opens one or more socket.io connections to the server, sends telemetry events
+at a fixed rate on each of them and measures the time until a `steer` reply
+comes back.
+
+A reply is matched to the most recent frame sent on its connection. Older
+frames still waiting for a reply then count as superseded, as the server
+dropped them or answered them late. Replies that arrive while no frame is
+waiting, e.g. the reply to connect or steering broadcast to all connections
+by drive.py, are counted as unsolicited and ignored.
+
+    python fake_sim.py --connections 4 --rate 30 --duration 20
+"""
+__author__ = 'Thomas Antony'
+
+import json
+import time
+import base64
+import argparse
+import threading
+from collections import deque
+
+import cv2
+import numpy as np
+import socketio
+
+from replay import latency_stats
+from telemetry_log import read_telemetry_log
+
+
+def synthetic_frames(n=30, width=320, height=160, seed=0):
+    """
+    Returns telemetry events with random road-like JPEG frames.
+    """
+    rng = np.random.RandomState(seed)
+    frames = []
+    for i in range(n):
+        img = np.zeros((height, width, 3), dtype=np.uint8)
+        img[:height//2] = (200, 150, 100)  # Sky
+        img[height//2:] = (90, 90, 90)     # Road
+        img += rng.randint(0, 30, img.shape).astype(np.uint8)
+        cv2.line(img, (width//2 + i - n//2, height), (width//2, height//2), (255, 255, 255), 3)
+        ok, jpeg = cv2.imencode('.jpg', img)
+        frames.append({'steering_angle': '0',
+                       'throttle': '0',
+                       'speed': '%0.4f' % (15 + 5*np.sin(i/5.)),
+                       'image': base64.b64encode(jpeg.tobytes()).decode('ascii')})
+    return frames
+
+
+def recorded_frames(path, limit=None):
+    frames = []
+    for received, data in read_telemetry_log(path):
+        frames.append(data)
+        if limit is not None and len(frames) >= limit:
+            break
+    return frames
+
+
+class FakeSimulator(object):
+    def __init__(self, url, frames, rate=30.0, timeout=1.0):
+        self.url = url
+        self.frames = frames
+        self.interval = 1./rate
+        self.timeout = timeout
+
+        self.lock = threading.Lock()
+        self.pending = deque()  # Send times of frames awaiting a reply
+        self.rtts = []
+        self.sent = 0
+        self.missed = 0
+        self.superseded = 0
+        self.unsolicited = 0
+
+        self.sio = socketio.Client()
+        self.sio.on('steer', self.on_steer)
+
+    def on_steer(self, data):
+        now = time.time()
+        with self.lock:
+            if not self.pending:
+                self.unsolicited += 1
+                return
+            self.rtts.append(now - self.pending[-1])
+            self.superseded += len(self.pending) - 1
+            self.pending.clear()
+
+    def expire(self, now):
+        with self.lock:
+            while self.pending and now - self.pending[0] > self.timeout:
+                self.pending.popleft()
+                self.missed += 1
+
+    def run(self, duration):
+        self.sio.connect(self.url)
+        start = time.time()
+        next_send = start
+        i = 0
+        while time.time() - start < duration:
+            now = time.time()
+            self.expire(now)
+            with self.lock:
+                self.pending.append(now)
+            self.sio.emit('telemetry', self.frames[i % len(self.frames)])
+            self.sent += 1
+            i += 1
+
+            next_send += self.interval
+            time.sleep(max(0.0, next_send - time.time()))
+
+        # Give outstanding replies a chance to arrive
+        time.sleep(self.timeout)
+        self.expire(time.time() + self.timeout)
+        self.sio.disconnect()
+
+
+def load_test(url, frames, connections=1, rate=30.0, duration=10.0, timeout=1.0):
+    sims = [FakeSimulator(url, frames, rate, timeout) for _ in range(connections)]
+    threads = [threading.Thread(target=sim.run, args=(duration,)) for sim in sims]
+    start = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.time() - start - timeout
+
+    rtts = [rtt for sim in sims for rtt in sim.rtts]
+    return {'connections': connections,
+            'rate_hz': rate,
+            'sent': sum(sim.sent for sim in sims),
+            'replies': len(rtts),
+            'missed': sum(sim.missed for sim in sims),
+            'superseded': sum(sim.superseded for sim in sims),
+            'unsolicited': sum(sim.unsolicited for sim in sims),
+            'throughput_hz': len(rtts)/elapsed,
+            'rtt_ms': latency_stats(rtts)}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fake simulator load test')
+    parser.add_argument('--url', type=str, default='http://localhost:4567')
+    parser.add_argument('--connections', type=int, default=1,
+        help='Number of concurrent simulator connections.')
+    parser.add_argument('--rate', type=float, default=30.,
+        help='Telemetry events per second on each connection.')
+    parser.add_argument('--duration', type=float, default=10.,
+        help='Seconds to send telemetry for.')
+    parser.add_argument('--timeout', type=float, default=1.,
+        help='Seconds after which a frame without a reply counts as missed.')
+    parser.add_argument('--log', type=str, default=None,
+        help='Send frames from a recorded telemetry log instead of synthetic ones.')
+    parser.add_argument('--json', action='store_true',
+        help='Print the results as JSON.')
+    args = parser.parse_args()
+
+    frames = recorded_frames(args.log) if args.log else synthetic_frames()
+    result = load_test(args.url, frames, args.connections, args.rate,
+                       args.duration, args.timeout)
+
+    if args.json:
+        print(json.dumps(result, indent=2))
+    else:
+        rtt = result['rtt_ms']
+        print('%d connections @ %.1f Hz: sent %d, replies %d, missed %d, superseded %d (%.1f replies/s)' %
+              (args.connections, args.rate, result['sent'], result['replies'],
+               result['missed'], result['superseded'], result['throughput_hz']))
+        print('rtt ms: p50 %.2f  p95 %.2f  p99 %.2f  max %.2f' %
+              (rtt['p50'], rtt['p95'], rtt['p99'], rtt['max']))
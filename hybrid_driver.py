@@ -6,14 +6,18 @@ __author__ = 'Thomas Antony'
 
 import os
 import sys
-import tkinter
+import time
 import argparse
 import base64
 import json
 import cv2
 
-from server import ControlServer
-from platform import system as platform
+import numpy as np
+
+from server import create_server, add_backend_arguments, backend_options
+from model_loader import ModelLoader, weights_path
+from weight_watcher import WeightWatcher, weight_shapes
+from status_window import StatusWindow
 
 import socketio
 import eventlet
@@ -21,13 +25,18 @@ import eventlet.wsgi
 from flask import Flask
 from functools import partial
 
-from keras.models import model_from_json
-
 class HybridDriver(object):
-    def __init__(self, model):
+    def __init__(self, model=None, headless=False, batch_window=0.,
+                 **server_options):
+        """
+        batch_window : if > 0, frames from concurrent simulator sessions that
+                       arrive within this many seconds are predicted as one
+                       batch (use with scheduling='latest')
+        """
         # Control variables
         self.steering_angle = 0
         self.throttle = 0
+        self.throttles = {} # Speed controller output for each session
 
         # State
         self.speed = 0
@@ -44,41 +53,107 @@ class HybridDriver(object):
         self.slow_down = partial(self.speed_control, direction=-1)
 
         # Control server for getting data from simulator
-        self.control_srv = ControlServer()
+        self.control_srv = create_server(**server_options)
         self.control_srv.register_callback(self) # Callback for telemetry
 
-        self.model = model
+        # Status window, re-rendered at a capped rate when the state changes
+        self.window = StatusWindow('Hybrid driver', self.render_status, [
+            ('<Left>', lambda e: self.turn_left()),
+            ('<Right>', lambda e: self.turn_right()),
+            ('<Up>', lambda e: self.speed_up()),
+            ('<Down>', lambda e: self.slow_down()),
+            ('<Key>', self.keydown)], headless=headless,
+            metrics=self.control_srv.metrics)
+
+        # Set by set_model(), the car is driven manually until then
+        self.model = None
+        self.engine = None
+        self.load_error = None
+        self.predictor = None
+        self.batch_window = batch_window
+
+        # Set by watch_weights(), reloads weights while driving
+        self.watcher = None
+        self.reloads = 0
 
         self.mode = 'auto' # can be 'auto' or 'manual'
 
-    def init_gui(self):
-        # Create the root window
-        self.root = tkinter.Tk()
-        self.root.geometry('350x75+490+550')
-        self.root.title('Hybrid driver')
-
-        # Create a label with status
-        self.status = tkinter.StringVar()
-        label = tkinter.Label(self.root, width=350, height=75,
-                              textvariable=self.status)
-        label.pack(fill=tkinter.BOTH, expand=1)
-
-        # Bind key event handlers
-        self.root.bind('<Left>', lambda e: self.turn_left())
-        self.root.bind('<Right>', lambda e: self.turn_right())
-        self.root.bind('<Up>', lambda e: self.speed_up())
-        self.root.bind('<Down>', lambda e: self.slow_down())
-        self.root.bind('<Key>', self.keydown)
+        if model is not None:
+            self.set_model(model)
+
+    def set_model(self, model):
+        """
+        Builds and warms up the inference engine for the model. May be called
+        from a background thread, the model is used once self.engine is set.
+        """
+        # Imported here so that TensorFlow is not loaded before the GUI is up
+        from inference import InferenceEngine
+
+        engine = InferenceEngine(model)
+        engine.warmup()
+        self.model = model
+        self.set_engine(engine)
+
+    def set_engine(self, engine):
+        """
+        Starts driving with a warmed-up engine: an InferenceEngine, a
+        NumpyEngine or an InferencePool of worker processes.
+        """
+        from batch_predictor import BatchPredictor
+
+        if self.batch_window > 0:
+            self.predictor = BatchPredictor(engine, self.batch_window,
+                sessions=lambda: len(self.control_srv.sessions))
+
+        self.engine = engine
+
+    def load_failed(self, error):
+        """
+        Called by ModelLoader. The car stays in manual control.
+        """
+        self.load_error = error
+        self.update_status()
 
+    def watch_weights(self, path, shapes):
+        """
+        Swaps in the weights from path whenever the file changes.
+
+        shapes : expected weight shapes of the model
+        """
+        self.watcher = WeightWatcher(path, shapes).start()
+
+    def reload_weights(self):
+        """
+        Swaps in weights loaded by the watcher. Called between frames.
+        """
+        if self.watcher is None or self.engine is None:
+            return
+        weights = self.watcher.take()
+        if weights is None:
+            return
+
+        t0 = time.perf_counter()
+        self.engine.set_weights(weights)
+        self.reloads += 1
+        self.control_srv.metrics.observe('weight_reload', time.perf_counter() - t0)
         self.update_status()
 
-        # Start UI loop
-        eventlet.spawn_after(1, self.main_loop)
+    def init_gui(self):
+        self.window.open()
+
+    def close(self):
+        """
+        Writes out the telemetry recording and the drive log.
+        """
+        self.control_srv.close()
 
     def keydown(self, event):
         if (event.char == 'q'):
-            self.root.destroy()
+            self.window.close()
+            self.close()
             os._exit(0) # Sledgehammer
+        elif event.char == 'p' or event.char == 'P':
+            self.control_srv.start_profile() # Written to ./profiles
         elif event.char == 'c' or event.char == 'C':
             self.reset_steering()
         elif event.char == 'x' or event.char == 'X':
@@ -88,29 +163,28 @@ class HybridDriver(object):
                 self.mode = 'manual'
 
     def start_server(self):
-        self.control_srv.start() # Start server
+        try:
+            self.control_srv.start() # Start server
+        finally:
+            self.close() # e.g. Ctrl-C when running headless
 
     def focus_gui(self):
-        self.root.focus_force()
-
-        # OSX code for focusing window
-        if platform() == 'Darwin':
-            os.system('''/usr/bin/osascript -e 'tell app "Finder" to set frontmost of process "python" to true' ''')
-
-    def main_loop(self):
-        self.focus_gui()
-        while True:
-            try:
-                self.root.update_idletasks()
-                self.root.update()
-            except:
-                pass
-            eventlet.sleep(0.01)
+        self.window.focus()
 
     def update_status(self):
+        self.window.invalidate()
+
+    def render_status(self):
         mode = 'Autonomous' if self.mode == 'auto' else 'Manual override'
-        self.status.set('Mode: %s\nSpeed = %0.2f mph, Steering angle = %0.2f deg' %
-                    (mode, self.speed, self.steering_angle*25))
+        if self.load_error is not None:
+            mode += ' (model failed to load: %s)' % self.load_error
+        elif self.engine is None:
+            mode += ' (loading model ...)'
+        status = ('Mode: %s\nSpeed = %0.2f mph, Steering angle = %0.2f deg' %
+                  (mode, self.speed, self.steering_angle*25))
+        if self.watcher is not None:
+            status += '\nWeights reloaded %d times' % self.reloads
+        return status
 
     def speed_control(self, direction):
         """
@@ -134,6 +208,7 @@ class HybridDriver(object):
         self.throttle = (self.speed - data['speed'])*K
         self.throttle = min(throttle_max, self.throttle)
         self.throttle = max(throttle_min, self.throttle)
+        self.throttles[data['sid']] = self.throttle
 
     def update_steering(self, data):
         """
@@ -162,28 +237,62 @@ class HybridDriver(object):
         self.update_status()
 
     def roi(self, img): # For model 5
-        return cv2.resize(img[60:140,40:280], (200, 66))
+        return cv2.resize(img[60:140,40:280].astype(np.float32, copy=False), (200, 66))
 
-    def predict_steering(self, data):
-        image_array = self.roi(cv2.cvtColor(data['image'], cv2.COLOR_RGB2YUV))
-        transformed_image_array = image_array[None, :, :, :]
+    def preprocess_input(self, img):
+        # Also called from the frame pipeline's preprocessing thread.
+        # Cropped and resized before the color conversion, so that only the small
+        # ROI is converted to float32. cvtColor offsets U and V by 128 for uint8
+        # input but by 0.5 for float32, so the conversion has to see float32 for
+        # both decode modes to give the model the same input.
+        return cv2.cvtColor(self.roi(img), cv2.COLOR_RGB2YUV)
 
-        return float(model.predict(transformed_image_array, batch_size=1))
+    def predict_steering(self, data):
+        metrics = self.control_srv.metrics
+        t0 = time.perf_counter()
+        if 'x' in data:
+            image_array = data['x'] # Preprocessed by the frame pipeline
+        else:
+            image_array = self.preprocess_input(data['image'])
+            # Per-frame timings for the drive log
+            data['preprocess_time'] = time.perf_counter() - t0
+            metrics.observe('preprocess', data['preprocess_time'])
+        t1 = time.perf_counter()
+
+        if self.predictor is not None:
+            steering_angle = self.predictor.predict(image_array)
+        else:
+            steering_angle = self.engine.predict(image_array)
+        data['predict_time'] = time.perf_counter() - t1
+        data['predicted_steering'] = steering_angle
+        metrics.observe('predict', data['predict_time'])
+        return steering_angle
 
     # Callback functions triggered by ControlServer
     def handle_connect(self, sid):
         # Focus window when simulator connects
         self.focus_gui()
 
+    def handle_disconnect(self, sid):
+        self.throttles.pop(sid, None)
+
     def handle_telemetry(self, data):
+        sid = data['sid']
+        data['mode'] = self.mode
+
+        if self.mode == 'auto' and self.engine is not None:
+            # Several sessions may be waiting on a batch, so keep the
+            # prediction for this frame local
+            steering_angle = self.predict_steering(data)
+            self.steering_angle = steering_angle
+        else:
+            steering_angle = self.steering_angle
 
-        if self.mode == 'auto':
-            self.steering_angle = self.predict_steering(data)
-        # elif self.mode == 'manual':
-        #     steering_angle = self.steering_angle
+        # Send current control variables to this simulator
+        self.control_srv.send_control(steering_angle, self.throttles.get(sid, 0), sid)
 
-        # Send current control variables to simulator
-        self.control_srv.send_control(self.steering_angle, self.throttle)
+        # Swap in a new checkpoint before the next frame
+        self.reload_weights()
 
         # Update UI
         self.update_status()
@@ -193,18 +302,74 @@ class HybridDriver(object):
         self.update_throttle(data)
 
 
+def load_model(path):
+    """
+    Loads the model definition json and the weights stored next to it.
+    """
+    from keras.models import model_from_json
+
+    with open(path, 'r') as jfile:
+        model = model_from_json(jfile.read())
+
+    model.compile("adam", "mse")
+    weights_file = path.replace('json', 'h5')
+    model.load_weights(weights_file)
+    return model
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Remote Driving')
     parser.add_argument('model', type=str,
         help='Path to model definition json. Model weights should be on the same path.')
+    parser.add_argument('--fast-decode', action='store_true',
+        help='Decode camera frames with OpenCV into uint8 instead of float32 with PIL.')
+    parser.add_argument('--latest-frame', action='store_true',
+        help='Only process the newest frame, dropping frames that arrive while busy.')
+    parser.add_argument('--record', type=str, default=None,
+        help='Record raw telemetry to this file for later replay.')
+    parser.add_argument('--drive-log', type=str, default=None,
+        help='Write a binary record of every frame to this file (see drive_log.py).')
+    parser.add_argument('--batch-window', type=float, default=0.,
+        help='Batch predictions of concurrent simulators arriving within this many ms.')
+    parser.add_argument('--workers', type=int, default=0,
+        help='Run the model in this many worker processes instead of in-process.')
+    parser.add_argument('--engine', choices=['keras', 'numpy'], default='keras',
+        help='Run the model with Keras or the pure-NumPy engine.')
+    parser.add_argument('--headless', action='store_true',
+        help='Run without the status window (no tkinter).')
+    add_backend_arguments(parser)
+    parser.add_argument('--watch', type=str, default=None,
+        help='Reload the weights from this file (e.g. checkpoint.h5) whenever it changes.')
     args = parser.parse_args()
-    with open(args.model, 'r') as jfile:
-        model = model_from_json(jfile.read())
+    if args.engine != 'keras' and args.workers > 0:
+        parser.error('--workers is only supported with the keras engine')
+    if args.pipeline and args.batch_window > 0:
+        parser.error('--batch-window needs concurrent frames, which --pipeline drives one at a time')
+
+    driver = HybridDriver(headless=args.headless,
+        batch_window=args.batch_window/1000.,
+        decode_mode='fast' if args.fast_decode else 'pil',
+        scheduling='latest' if args.latest_frame else 'inline',
+        record_path=args.record,
+        drive_log_path=args.drive_log,
+        **backend_options(args))
+    driver.init_gui()
 
-    model.compile("adam", "mse")
-    weights_file = args.model.replace('json', 'h5')
-    model.load_weights(weights_file)
+    if args.watch:
+        driver.watch_weights(args.watch, weight_shapes(weights_path(args.model)))
+
+    # Load the model in the background while the server accepts connections
+    load_fn = partial(load_model, args.model)
+
+    if args.engine == 'numpy':
+        from numpy_engine import load_engine
+        ModelLoader(partial(load_engine, args.model), driver.set_engine,
+                    driver.load_failed).start()
+    elif args.workers > 0:
+        from process_pool import InferencePool
+        ModelLoader(partial(InferencePool, load_fn, args.workers),
+                    driver.set_engine, driver.load_failed).start()
+    else:
+        ModelLoader(load_fn, driver.set_model, driver.load_failed).start()
 
-    driver = HybridDriver(model)
-    driver.init_gui()
     driver.start_server()
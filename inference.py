@@ -0,0 +1,59 @@
+"""
+Single-frame inference engine for Keras models
+
+`model.predict` validates and batches its input on every call, which costs
+more than the forward pass itself for one small image. The engine builds the
+backend predict function once and feeds it a reusable input buffer, so each
+call is a single session run.
+
+All engines (InferenceEngine, NumpyEngine and process_pool's InferencePool)
+have the same interface: predict(image), predict_batch(images), warmup() and
+set_weights(weights), so the drivers can use any of them.
+"""
+__author__ = 'Thomas Antony'
+
+import numpy as np
+from keras import backend as K
+
+
+class InferenceEngine(object):
+    def __init__(self, model):
+        self.model = model
+
+        inputs = list(model.inputs)
+        self.feed = [np.zeros((1,) + tuple(model.input_shape[1:]), dtype=np.float32)]
+        if model.uses_learning_phase:
+            inputs.append(K.learning_phase())
+            self.feed.append(0) # Test mode
+        self.predict_fn = K.function(inputs, model.outputs)
+
+        self.x = self.feed[0]
+
+    def predict(self, image):
+        """
+        Returns the model output for a single preprocessed image as a float.
+        """
+        np.copyto(self.x[0], image, casting='unsafe')
+        return float(self.predict_fn(self.feed)[0][0, 0])
+
+    def predict_batch(self, images):
+        """
+        Returns the model outputs for a batch of preprocessed images.
+        """
+        feed = [np.asarray(images, dtype=np.float32)] + self.feed[1:]
+        return self.predict_fn(feed)[0][:, 0]
+
+    def warmup(self, n=3):
+        """
+        Runs a few predictions so that one-off graph and memory setup happens
+        before the first real frame.
+        """
+        self.x[...] = 0
+        for i in range(n):
+            self.predict_fn(self.feed)
+
+    def set_weights(self, weights):
+        """
+        Sets the model weights from a list in the order of model.get_weights().
+        """
+        self.model.set_weights(weights)
@@ -8,7 +8,15 @@ Live trainer script for Udacity SDC sim
 
 
 training_batch_size = 16
+replay_capacity = 2048      # Samples kept in memory for replay
+replay_batch_size = 64      # Fresh batch + older samples drawn from replay
+augment_copies = 2          # Augmented copies of every sample fed to training
+novelty_threshold = 3.0     # Mean Y difference (0-255) below which frames are duplicates
+novelty_steering = 0.01     # Steering difference below which angles are duplicates
 checkpoint_filename = './checkpoint.h5'
+checkpoint_interval = 10.0  # Minimum seconds between checkpoints
+checkpoint_keep = 5         # Versioned checkpoints kept next to checkpoint_filename
+dataset_path = './live_data'  # Directory that collected samples are saved to
 learning_rate = 0.00001
 
 ## PLEASE DO NOT EDIT PAST THIS POINT
@@ -17,15 +25,20 @@ __author__ = 'Thomas Antony'
 import os
 import sys
 import time
-import tkinter
 import argparse
 import base64
 import json
 import cv2
 
 import numpy as np
-from server import ControlServer
-from platform import system as platform
+from server import create_server, add_backend_arguments, backend_options
+from model_loader import ModelLoader
+from replay_memory import ReplayMemory
+from dataset_store import DatasetWriter
+from status_window import StatusWindow
+from augment import AugmentationProducer
+from checkpoint import CheckpointManager
+from novelty import NoveltyFilter
 
 import socketio
 import eventlet
@@ -33,11 +46,8 @@ import eventlet.wsgi
 from flask import Flask
 from functools import partial
 
-from keras.models import model_from_json
-from keras.optimizers import Adam
-
 class LiveTrainer(object):
-    def __init__(self, model):
+    def __init__(self, model=None, headless=False, **server_options):
         # Control variables
         self.steering_angle = 0
         self.throttle = 0
@@ -58,68 +68,117 @@ class LiveTrainer(object):
         self.slow_down = partial(self.speed_control, direction=-1)
 
         # Control server for getting data from simulator
-        self.control_srv = ControlServer()
+        self.control_srv = create_server(**server_options)
         self.control_srv.register_callback(self) # Callback for telemetry
 
+        # Status window, re-rendered at a capped rate when the state changes
+        self.window = StatusWindow('SDC Live Trainer', self.render_status, [
+            ('<Left>', lambda e: self.turn_left()),
+            ('<Right>', lambda e: self.turn_right()),
+            ('<Up>', lambda e: self.speed_up()),
+            ('<Down>', lambda e: self.slow_down()),
+            ('<Key>', self.keydown)], headless=headless,
+            metrics=self.control_srv.metrics)
+
         self.mode = 'auto' # can be 'auto' or 'manual'
         self.is_training = False # Trains model if set to true
 
-        self.model = model
-        self.current_X = [] # List of images
-        self.current_Y = [] # List of steering angles
+        # Set by set_model(), the car is driven manually until then
+        self.model = None
+        self.engine = None
+        self.load_error = None
+        self.trainer = None
+        self.augmenter = None
+
+        self.memory = ReplayMemory(replay_capacity)
+        self.novelty = NoveltyFilter(min_difference=novelty_threshold,
+                                     min_steering_change=novelty_steering)
+        self.new_samples = 0 # Samples added since the last training batch
+        self.batch_speeds = np.zeros(training_batch_size, dtype=np.float32)
+        self.batch_throttles = np.zeros(training_batch_size, dtype=np.float32)
+
+        # Collected samples are appended to disk by a background writer
+        self.dataset = DatasetWriter(dataset_path)
+
+        # Trained weights are checkpointed by a background writer
+        self.checkpoints = CheckpointManager(checkpoint_filename, checkpoint_interval,
+                                             keep=checkpoint_keep,
+                                             metrics=self.control_srv.metrics).start()
 
         # Performance metrics
         self.start_time = None
         self.last_switch_time = None
         self.auto_time = 0
 
-    def init_gui(self):
-        # Create the root window
-        self.root = tkinter.Tk()
-        self.root.geometry('350x75+490+550')
-        self.root.title('SDC Live Trainer')
-
-        # Create a label with status
-        self.status = tkinter.StringVar()
-        label = tkinter.Label(self.root, width=350, height=75,
-                              textvariable=self.status)
-        label.pack(fill=tkinter.BOTH, expand=1)
-
-        # Bind key event handlers
-        self.root.bind('<Left>', lambda e: self.turn_left())
-        self.root.bind('<Right>', lambda e: self.turn_right())
-        self.root.bind('<Up>', lambda e: self.speed_up())
-        self.root.bind('<Down>', lambda e: self.slow_down())
-        self.root.bind('<Key>', self.keydown)
+        if model is not None:
+            self.set_model(model)
 
+    def load_failed(self, error):
+        """
+        Called by ModelLoader. Driving and training stay manual.
+        """
+        self.load_error = error
         self.update_status()
 
-        # Start UI loop
-        eventlet.spawn_after(1, self.main_loop)
+    def set_model(self, model, engine=None):
+        """
+        Builds the training worker and the warmed-up inference engine for the
+        model. May be called from a background thread, the model is used once
+        self.engine is set.
 
-    def start_server(self):
-        self.control_srv.start() # Start server
+        engine : optional prebuilt engine (e.g. an InferencePool) to drive
+                 with instead of an in-process InferenceEngine
+        """
+        # Imported here so that TensorFlow is not loaded before the GUI is up
+        from keras.optimizers import Adam
+        from inference import InferenceEngine
+        from training_worker import TrainingWorker
 
-    def focus_gui(self):
-        self.root.focus_force()
+        # Training happens on a shadow copy of the model in a separate thread
+        trainer = TrainingWorker(model, Adam(lr=learning_rate),
+                                 self.train_model,
+                                 metrics=self.control_srv.metrics)
+        trainer.start()
 
-        # OSX code for focusing window
-        if platform() == 'Darwin':
-            os.system('''/usr/bin/osascript -e 'tell app "Finder" to set frontmost of process "python" to true' ''')
+        # Batches are augmented in another thread on their way to the trainer
+        augmenter = AugmentationProducer(trainer, augment_copies)
+        augmenter.start()
 
-    def main_loop(self):
-        self.focus_gui()
-        while True:
-            try:
-                self.root.update_idletasks()
-                self.root.update()
-            except:
-                pass
-            eventlet.sleep(0.01)
+        if engine is None:
+            engine = InferenceEngine(model)
+            engine.warmup()
+
+        self.model = model
+        self.trainer = trainer
+        self.augmenter = augmenter
+        self.engine = engine
+
+    def init_gui(self):
+        self.window.open()
+
+    def start_server(self):
+        try:
+            self.control_srv.start() # Start server
+        finally:
+            self.close() # e.g. Ctrl-C when running headless
+
+    def focus_gui(self):
+        self.window.focus()
 
     def update_status(self):
+        self.window.invalidate()
+
+    def render_status(self):
         mode = 'Autopilot Engaged' if self.mode == 'auto' else 'Manual override'
-        train_text = 'Training neural net ...' if self.is_training else ''
+        if self.load_error is not None:
+            mode += ' (model failed to load: %s)' % self.load_error
+        elif self.engine is None:
+            mode += ' (loading model ...)'
+        if self.is_training and self.trainer is not None:
+            train_text = 'Training neural net ... (queued {0}, dropped {1}, skipped {2} frames)'.format(
+                self.trainer.queue_depth, self.trainer.dropped_batches, self.novelty.rejected)
+        else:
+            train_text = ''
 
         if self.start_time is not None:
             now = time.time()
@@ -133,7 +192,7 @@ class LiveTrainer(object):
             rating = 0.0
         status_txt = '{0}\nAutnomous rating: {1:.2%}\n{2}\nSpeed = {3:4.2f} mph, Steering angle = {4:4.2f} deg'
 
-        self.status.set(status_txt.format(mode, rating, train_text, self.speed, self.steering_angle*25))
+        return status_txt.format(mode, rating, train_text, self.speed, self.steering_angle*25)
 
     def update_timers(self):
         """
@@ -145,10 +204,21 @@ class LiveTrainer(object):
         else:
             self.auto_time += time.time() - self.last_switch_time
 
+    def close(self):
+        """
+        Writes out the logs, the dataset and the final checkpoint.
+        """
+        self.control_srv.close()
+        self.dataset.close()
+        self.save_checkpoint()
+
     def keydown(self, event):
         if (event.char == 'q'):
-            self.root.destroy()
+            self.window.close()
+            self.close()
             os._exit(0) # Sledgehammer
+        elif event.char == 'p' or event.char == 'P':
+            self.control_srv.start_profile() # Written to ./profiles
         elif event.char == 'c' or event.char == 'C':
             self.reset_steering()
         elif event.char == 'x' or event.char == 'X':
@@ -213,51 +283,102 @@ class LiveTrainer(object):
         self.steering_angle = 0.0
         self.update_status()
 
-    def roi(self, img): # For model 5
-        return cv2.resize(img[60:140,40:280], (200, 66))
+    @staticmethod
+    def roi(img): # For model 5
+        return cv2.resize(img[60:140,40:280].astype(np.float32, copy=False), (200, 66))
 
-    def preprocess_input(self, img):
-        return self.roi(cv2.cvtColor(img, cv2.COLOR_RGB2YUV))
+    @staticmethod
+    def preprocess_input(img):
+        # Static so that offline_trainer.py can preprocess recorded frames.
+        # Cropped and resized before the color conversion, so that only the small
+        # ROI is converted to float32. cvtColor offsets U and V by 128 for uint8
+        # input but by 0.5 for float32, so the conversion has to see float32 for
+        # both decode modes to give the model the same input.
+        return cv2.cvtColor(LiveTrainer.roi(img), cv2.COLOR_RGB2YUV)
 
-    def predict_steering(self, data):
+    def input_array(self, data):
+        """
+        Preprocessed frame, taken from the frame pipeline if it ran already.
+        """
+        if 'x' in data:
+            return data['x']
+        t0 = time.perf_counter()
         x = self.preprocess_input(data['image'])
-        x = x[None, :, :, :]    # Extend dimension
-        return float(model.predict(x, batch_size=1))
+        # Per-frame timings for the drive log
+        data['preprocess_time'] = time.perf_counter() - t0
+        self.control_srv.metrics.observe('preprocess', data['preprocess_time'])
+        return x
+
+    def predict_steering(self, data):
+        x = self.input_array(data)
+        t0 = time.perf_counter()
+        steering_angle = self.engine.predict(x)
+        data['predict_time'] = time.perf_counter() - t0
+        data['predicted_steering'] = steering_angle
+        self.control_srv.metrics.observe('predict', data['predict_time'])
+        return steering_angle
 
     def save_batch(self, data):
         """
         Saves training data in current batch to disk.
+
+        data = (images, steering angles, speeds, throttles)
         """
-        # TODO: Implement save_batch()
-        pass
+        self.dataset.append(*data)
 
     def train_model(self, model, X_train, y_train):
+        """
+        Runs in the training worker thread on the shadow model.
+        """
         h = model.fit(X_train, y_train,
             nb_epoch = 1, verbose=0, batch_size=training_batch_size)
-        model.save_weights(checkpoint_filename)
-        print('loss : ',h.history['loss'][-1])
-        return model
+        loss = h.history['loss'][-1]
+        self.checkpoints.save(model, loss)
+        print('loss : ', loss)
+        return loss
+
+    def save_checkpoint(self):
+        """
+        Stops training and writes the final weights, which may be newer than
+        the last periodic checkpoint.
+        """
+        if self.trainer is not None:
+            self.trainer.stop()
+            with self.trainer.graph.as_default():
+                self.checkpoints.save_final(self.trainer.shadow, self.trainer.last_loss)
+        self.checkpoints.flush()
 
     def process_data(self, data):
         """
-        If current batch is full, train the model, save data and reset cache.
-        else just save data into batch
+        Adds the sample to replay memory unless it is a near-duplicate of a
+        recent one. Once a full batch of new samples has been collected, queue
+        a minibatch of the new samples mixed with older ones for training and
+        save the new samples.
         """
-        self.current_X.append(self.preprocess_input(data['image']))
-        self.current_Y.append(self.steering_angle)
+        metrics = self.control_srv.metrics
+        x = self.input_array(data)
 
-        if len(self.current_Y) == training_batch_size:
-            X_train = np.array(self.current_X)
-            y_train = np.array(self.current_Y)
+        if not self.novelty.admit(x, self.steering_angle):
+            metrics.increment('frames_rejected')
+            return
+        metrics.increment('frames_admitted')
 
-            print('Training model ...')
-            self.train_model(self.model, X_train, y_train)
+        self.memory.add(x, self.steering_angle)
+        self.batch_speeds[self.new_samples] = data['speed']
+        self.batch_throttles[self.new_samples] = data['throttle']
+        self.new_samples += 1
 
-            self.save_batch((X_train, y_train))
+        if self.new_samples == training_batch_size:
+            X_train, y_train = self.memory.sample(replay_batch_size,
+                                                  fresh=training_batch_size)
+            if self.augmenter is not None:
+                self.augmenter.submit(X_train, y_train)
 
-            # Reset internal batch
-            self.current_X = []
-            self.current_Y = []
+            X_new, y_new = self.memory.latest(training_batch_size)
+            self.save_batch((X_new, y_new,
+                             self.batch_speeds.copy(), self.batch_throttles.copy()))
+
+            self.new_samples = 0
 
     # Callback functions triggered by ControlServer
     def handle_connect(self, sid):
@@ -270,8 +391,10 @@ class LiveTrainer(object):
         self.focus_gui()
 
     def handle_telemetry(self, data):
+        data['mode'] = self.mode
+        data['training'] = self.mode == 'manual' and self.is_training
 
-        if self.mode == 'auto':
+        if self.mode == 'auto' and self.engine is not None:
             self.steering_angle = self.predict_steering(data)
         elif self.mode == 'manual':
             steering_angle = self.steering_angle
@@ -280,7 +403,11 @@ class LiveTrainer(object):
                 self.process_data(data)
 
         # Send current control variables to simulator
-        self.control_srv.send_control(self.steering_angle, self.throttle)
+        self.control_srv.send_control(self.steering_angle, self.throttle, data['sid'])
+
+        # Swap in freshly trained weights before the next frame
+        if self.trainer is not None:
+            self.trainer.apply_updates(self.engine)
 
         # Update UI
         self.update_status()
@@ -290,21 +417,63 @@ class LiveTrainer(object):
         self.update_throttle(data)
 
 
-if __name__ == '__main__':
-    parser = argparse.ArgumentParser(description='Remote Driving')
-    parser.add_argument('model', type=str,
-        help='Path to model definition json. Model weights should be on the same path.')
-    args = parser.parse_args()
-    with open(args.model, 'r') as jfile:
+def load_model(path):
+    """
+    Loads the model definition json and, if present, the weights stored next
+    to it.
+    """
+    from keras.models import model_from_json
+    from keras.optimizers import Adam
+
+    with open(path, 'r') as jfile:
         model = model_from_json(jfile.read())
 
     adam = Adam(lr=learning_rate)
     model.compile(adam, "mse")
-    weights_file = args.model.replace('json', 'h5')
+    weights_file = path.replace('json', 'h5')
 
     if os.path.exists(weights_file):
         model.load_weights(weights_file)
+    return model
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Remote Driving')
+    parser.add_argument('model', type=str,
+        help='Path to model definition json. Model weights should be on the same path.')
+    parser.add_argument('--fast-decode', action='store_true',
+        help='Decode camera frames with OpenCV into uint8 instead of float32 with PIL.')
+    parser.add_argument('--latest-frame', action='store_true',
+        help='Only process the newest frame, dropping frames that arrive while busy.')
+    parser.add_argument('--record', type=str, default=None,
+        help='Record raw telemetry to this file for later replay.')
+    parser.add_argument('--drive-log', type=str, default=None,
+        help='Write a binary record of every frame to this file (see drive_log.py).')
+    parser.add_argument('--workers', type=int, default=0,
+        help='Run inference in this many worker processes instead of in-process.')
+    parser.add_argument('--headless', action='store_true',
+        help='Run without the status window (no tkinter).')
+    add_backend_arguments(parser)
+    args = parser.parse_args()
 
-    driver = LiveTrainer(model)
+    driver = LiveTrainer(headless=args.headless,
+        decode_mode='fast' if args.fast_decode else 'pil',
+        scheduling='latest' if args.latest_frame else 'inline',
+        record_path=args.record,
+        drive_log_path=args.drive_log,
+        **backend_options(args))
     driver.init_gui()
+
+    # Load the model in the background while the server accepts connections
+    load_fn = partial(load_model, args.model)
+
+    if args.workers > 0:
+        from process_pool import InferencePool
+        def load_with_pool():
+            return load_fn(), InferencePool(load_fn, args.workers)
+        ModelLoader(load_with_pool, lambda r: driver.set_model(*r),
+                    driver.load_failed).start()
+    else:
+        ModelLoader(load_fn, driver.set_model, driver.load_failed).start()
+
     driver.start_server()
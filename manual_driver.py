@@ -4,10 +4,10 @@ Script for manual control of Udacity SDC sim using keyboard
 __author__ = 'Thomas Antony'
 
 import sys
-import tkinter
 import os
-from server import ControlServer
-from platform import system as platform
+import argparse
+from server import create_server, add_backend_arguments, backend_options
+from status_window import StatusWindow
 
 import socketio
 import eventlet
@@ -16,7 +16,7 @@ from flask import Flask
 from functools import partial
 
 class ManualDriver(object):
-    def __init__(self):
+    def __init__(self, headless=False, **server_options):
         # Control variables
         self.steering_angle = 0
         self.throttle = 0
@@ -35,62 +35,53 @@ class ManualDriver(object):
         self.speed_up = partial(self.speed_control, direction=+1)
         self.slow_down = partial(self.speed_control, direction=-1)
 
-        # Control server for getting data from simulator
-        self.control_srv = ControlServer()
+        # Control server for getting data from simulator. The camera image is
+        # not used here, so take the cheap decode path.
+        server_options.setdefault('decode_mode', 'fast')
+        self.control_srv = create_server(**server_options)
         self.control_srv.register_callback(self) # Callback for telemetry
 
-    def init_gui(self):
-        # Create the root window
-        self.root = tkinter.Tk()
-        self.root.geometry('350x75+490+550')
-        self.root.title('Manual driver')
-
-        # Create a label with status
-        self.status = tkinter.StringVar()
-        label = tkinter.Label(self.root, width=350, height=75,
-                              textvariable=self.status)
-        label.pack(fill=tkinter.BOTH, expand=1)
-
-        # Bind key event handlers
-        self.root.bind('<Left>', lambda e: self.turn_left())
-        self.root.bind('<Right>', lambda e: self.turn_right())
-        self.root.bind('<Up>', lambda e: self.speed_up())
-        self.root.bind('<Down>', lambda e: self.slow_down())
-        self.root.bind('<Key>', self.keydown)
-
-        self.update_status()
+        # Status window, re-rendered at a capped rate when the state changes
+        self.window = StatusWindow('Manual driver', self.render_status, [
+            ('<Left>', lambda e: self.turn_left()),
+            ('<Right>', lambda e: self.turn_right()),
+            ('<Up>', lambda e: self.speed_up()),
+            ('<Down>', lambda e: self.slow_down()),
+            ('<Key>', self.keydown)], headless=headless,
+            metrics=self.control_srv.metrics)
 
-        # Start UI loop
-        eventlet.spawn_after(1, self.main_loop)
+    def init_gui(self):
+        self.window.open()
 
     def start_server(self):
-        self.control_srv.start() # Start server
+        try:
+            self.control_srv.start() # Start server
+        finally:
+            self.close() # e.g. Ctrl-C when running headless
 
     def focus_gui(self):
-        self.root.focus_force()
+        self.window.focus()
 
-        # OSX code for focusing window
-        if platform() == 'Darwin':
-            os.system('''/usr/bin/osascript -e 'tell app "Finder" to set frontmost of process "python" to true' ''')
+    def update_status(self):
+        self.window.invalidate()
 
-    def main_loop(self):
-        self.focus_gui()
-        while True:
-            try:
-                self.root.update_idletasks()
-                self.root.update()
-            except:
-                pass
-            eventlet.sleep(0.01)
+    def render_status(self):
+        return ('Speed = %0.2f mph, Steering angle = %0.2f deg' %
+                (self.speed, self.steering_angle*25))
 
-    def update_status(self):
-        self.status.set('Speed = %0.2f mph, Steering angle = %0.2f deg' %
-                    (self.speed, self.steering_angle*25))
+    def close(self):
+        """
+        Writes out the telemetry recording and the drive log.
+        """
+        self.control_srv.close()
 
     def keydown(self, event):
         if (event.char == 'q'):
-            self.root.destroy()
+            self.window.close()
+            self.close()
             os._exit(0) # Sledgehammer
+        elif event.char == 'p' or event.char == 'P':
+            self.control_srv.start_profile() # Written to ./profiles
         elif event.char == 'c' or event.char == 'C':
             self.reset_steering()
 
@@ -149,8 +140,9 @@ class ManualDriver(object):
         self.focus_gui()
 
     def handle_telemetry(self, data):
+        data['mode'] = 'manual'
         # Send current control variables to simulator
-        self.control_srv.send_control(self.steering_angle, self.throttle)
+        self.control_srv.send_control(self.steering_angle, self.throttle, data['sid'])
 
         # Update UI
         self.update_status()
@@ -161,6 +153,18 @@ class ManualDriver(object):
 
 
 if __name__ == '__main__':
-    driver = ManualDriver()
+    parser = argparse.ArgumentParser(description='Manual Driving')
+    parser.add_argument('--record', type=str, default=None,
+        help='Record raw telemetry to this file for later replay.')
+    parser.add_argument('--drive-log', type=str, default=None,
+        help='Write a binary record of every frame to this file (see drive_log.py).')
+    parser.add_argument('--headless', action='store_true',
+        help='Run without the status window (no tkinter).')
+    add_backend_arguments(parser)
+    args = parser.parse_args()
+
+    driver = ManualDriver(headless=args.headless, record_path=args.record,
+                         drive_log_path=args.drive_log,
+                         **backend_options(args))
     driver.init_gui()
     driver.start_server()
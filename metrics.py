@@ -0,0 +1,84 @@
+"""
+Low-overhead latency histograms and counters
+
+Histograms use fixed, logarithmically spaced buckets so that recording a
+value is a bisect and a few additions, with no allocation.
+"""
+__author__ = 'Thomas Antony'
+
+import time
+import bisect
+
+
+def log_buckets(lowest=1e-5, highest=10., factor=2.):
+    bounds = []
+    b = lowest
+    while b < highest:
+        bounds.append(b)
+        b *= factor
+    bounds.append(highest)
+    return bounds
+
+
+class Histogram(object):
+    def __init__(self, bounds=None):
+        self.bounds = bounds if bounds is not None else log_buckets()
+        self.counts = [0]*(len(self.bounds) + 1) # Last bucket is overflow
+        self.count = 0
+        self.sum = 0.
+        self.max = 0.
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, q):
+        """
+        Upper bound of the bucket that contains the q-th percentile.
+        """
+        if self.count == 0:
+            return 0.
+        target = q/100.*self.count
+        seen = 0
+        for bound, n in zip(self.bounds, self.counts):
+            seen += n
+            if seen >= target:
+                return min(bound, self.max)
+        return self.max
+
+    def to_dict(self):
+        return {'count': self.count,
+                'mean': self.sum/self.count if self.count else 0.,
+                'max': self.max,
+                'p50': self.percentile(50),
+                'p95': self.percentile(95),
+                'p99': self.percentile(99),
+                'buckets': [[b, n] for b, n in zip(self.bounds + ['inf'], self.counts) if n]}
+
+
+class Metrics(object):
+    """
+    Named histograms (in seconds) and counters.
+    """
+    def __init__(self):
+        self.started = time.time()
+        self.histograms = {}
+        self.counters = {}
+
+    def observe(self, name, seconds):
+        h = self.histograms.get(name)
+        if h is None:
+            h = self.histograms[name] = Histogram()
+        h.observe(seconds)
+
+    def increment(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def to_dict(self):
+        return {'uptime_s': time.time() - self.started,
+                'counters': dict(self.counters),
+                'latency_s': dict((name, h.to_dict())
+                                  for name, h in sorted(list(self.histograms.items())))}
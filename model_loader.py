@@ -0,0 +1,57 @@
+"""
+Background model loading
+
+Importing Keras/TensorFlow and building the model takes several seconds, so
+the drivers start their server and GUI first and load the model in a
+`ModelLoader` thread. Until the model is ready the drivers send manual (zero)
+controls.
+"""
+__author__ = 'Thomas Antony'
+
+import os
+import time
+import threading
+import traceback
+
+
+def weights_path(json_path):
+    return json_path.replace('json', 'h5')
+
+
+class ModelLoader(object):
+    def __init__(self, load_fn, on_ready, on_error=None):
+        """
+        load_fn  : load_fn() -> model, called in the loader thread
+        on_ready : on_ready(model), called in the loader thread once loaded
+        on_error : on_error(exception), called in the loader thread if loading
+                   fails. Without it a failed load exits the program, so that
+                   it does not keep running without a model.
+        """
+        self.load_fn = load_fn
+        self.on_ready = on_ready
+        self.on_error = on_error
+        self.load_time = None
+        self.error = None
+
+        self.thread = threading.Thread(target=self.run, name='model-loader')
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def run(self):
+        start = time.time()
+        try:
+            model = self.load_fn()
+            self.on_ready(model)
+        except Exception as e:
+            self.error = e
+            traceback.print_exc()
+            print('Failed to load model: %s' % e)
+            if self.on_error is None:
+                os._exit(1)
+            self.on_error(e)
+            return
+        self.load_time = time.time() - start
+        print('Model ready after %0.2f s' % self.load_time)
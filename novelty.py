@@ -0,0 +1,65 @@
+"""
+Novelty filter for live-training samples
+
+At low speed or on straights consecutive frames are nearly identical and have
+the same steering angle. `NoveltyFilter` compares a small thumbnail of the Y
+(luma) channel of each preprocessed frame, plus its steering angle, with the
+last `history` admitted samples. A frame is rejected if one of them looks the
+same and was steered the same way. Only admitted frames are trained on and
+saved.
+"""
+__author__ = 'Thomas Antony'
+
+import cv2
+import numpy as np
+
+
+class NoveltyFilter(object):
+    def __init__(self, history=32, min_difference=3.0, min_steering_change=0.01,
+                 thumbnail_size=(25, 8)):
+        """
+        history             : number of recently admitted samples compared against
+        min_difference      : mean absolute Y difference (0-255) of the
+                              thumbnails below which frames look the same
+        min_steering_change : steering difference below which angles are the same
+        thumbnail_size      : (width, height) the Y channel is downscaled to
+        """
+        self.min_difference = min_difference
+        self.min_steering_change = min_steering_change
+        self.thumbnail_size = thumbnail_size
+
+        self.thumbnails = np.zeros((history, thumbnail_size[1], thumbnail_size[0]),
+                                   dtype=np.float32)
+        self.steering = np.zeros(history, dtype=np.float32)
+        self.count = 0
+        self.next = 0
+
+        # Statistics
+        self.admitted = 0
+        self.rejected = 0
+
+    def thumbnail(self, image):
+        return cv2.resize(image[..., 0], self.thumbnail_size,
+                          interpolation=cv2.INTER_AREA).astype(np.float32)
+
+    def admit(self, image, steering_angle):
+        """
+        Returns True if the preprocessed YUV image and steering angle are
+        different enough from the recent samples, and remembers them if so.
+        """
+        thumbnail = self.thumbnail(image)
+
+        n = self.count
+        difference = np.abs(self.thumbnails[:n] - thumbnail).mean(axis=(1, 2))
+        same = ((difference < self.min_difference) &
+                (np.abs(self.steering[:n] - steering_angle) < self.min_steering_change))
+        if same.any():
+            self.rejected += 1
+            return False
+
+        self.thumbnails[self.next] = thumbnail
+        self.steering[self.next] = steering_angle
+        self.next = (self.next + 1) % len(self.steering)
+        self.count = min(self.count + 1, len(self.steering))
+        self.admitted += 1
+        return True
@@ -0,0 +1,367 @@
+"""
+Pure-NumPy inference engine for the model_5 architecture
+
+Runs the forward pass of a Sequential Keras 1 model without importing Keras or
+TensorFlow. The layer configuration comes from the model json and the weights
+from the matching .h5 file. Convolutions use im2col and one matrix multiply
+per layer. The windows are gathered through a strided view into preallocated
+per-layer buffers, so a prediction allocates no large arrays.
+
+Supported layers are the ones model_5 uses: Lambda, valid Convolution2D (tf
+dim ordering), Flatten, Dense, Dropout and Activation, as well as ELU. The
+activations are linear, relu, elu, tanh and sigmoid. The Lambda layer's
+function is stored as marshalled Python bytecode and cannot be read portably,
+so it is assumed to be model_5's input normalization x/127.5 - 1.
+
+The engine has the same predict/predict_batch/warmup interface as
+InferenceEngine. Comparison against Keras and latency benchmark:
+
+    python numpy_engine.py model_5.json --compare
+"""
+__author__ = 'Thomas Antony'
+
+import json
+import time
+import argparse
+from functools import partial
+
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+from model_loader import weights_path
+from weight_watcher import read_layer_weights
+
+
+def elu(x, alpha=1.):
+    """
+    Keras' elu, x if x > 0 else alpha*(exp(x) - 1), in place.
+    """
+    negative = x < 0
+    x[negative] = alpha*np.expm1(x[negative])
+    return x
+
+
+activations = {
+    'linear': None,
+    'elu': elu,
+    'relu': lambda x: np.maximum(x, 0, out=x),
+    'tanh': lambda x: np.tanh(x, out=x),
+    'sigmoid': lambda x: np.divide(1, np.add(1, np.exp(np.negative(x, out=x), out=x), out=x), out=x),
+}
+
+
+def activation(name, alpha=None):
+    """
+    alpha : for elu, the value approached for large negative inputs
+    """
+    if name not in activations:
+        raise ValueError('Unsupported activation %s' % name)
+    if alpha is not None:
+        return partial(activations[name], alpha=alpha)
+    return activations[name]
+
+
+class Layer(object):
+    n_weights = 0
+
+    def __init__(self, name, input_shape):
+        self.name = name
+        self.input_shape = tuple(input_shape)
+        self.output_shape = self.input_shape
+
+    def set_weights(self, weights):
+        pass
+
+    def allocate(self, n):
+        pass
+
+    def forward(self, x, n):
+        return x
+
+
+class Normalize(Layer):
+    """
+    model_5's Lambda layer, x/127.5 - 1.
+    """
+    def __init__(self, name, input_shape, scale=1/127.5, offset=-1.):
+        Layer.__init__(self, name, input_shape)
+        self.scale = np.float32(scale)
+        self.offset = np.float32(offset)
+
+    def allocate(self, n):
+        self.out = np.empty((n,) + self.output_shape, dtype=np.float32)
+
+    def forward(self, x, n):
+        out = self.out[:n]
+        np.multiply(x, self.scale, out=out, casting='unsafe')
+        out += self.offset
+        return out
+
+
+class Conv2D(Layer):
+    n_weights = 2
+
+    def __init__(self, name, input_shape, filters, rows, cols, stride, activation_name):
+        Layer.__init__(self, name, input_shape)
+        h, w, c = self.input_shape
+        self.filters = filters
+        self.kernel = (rows, cols)
+        self.stride = tuple(stride)
+        self.output_shape = ((h - rows)//self.stride[0] + 1,
+                             (w - cols)//self.stride[1] + 1, filters)
+        self.activation = activation(activation_name)
+
+    def set_weights(self, weights):
+        W, b = weights
+        # (rows, cols, channels, filters) -> (rows*cols*channels, filters),
+        # matching the order of the im2col windows
+        self.W = np.ascontiguousarray(W, dtype=np.float32).reshape(-1, self.filters)
+        self.b = np.asarray(b, dtype=np.float32)
+
+    def matmul(self, a, out):
+        np.dot(a, self.W, out=out)
+
+    def allocate(self, n):
+        ho, wo, f = self.output_shape
+        self.cols = np.empty((n, ho, wo) + self.kernel + self.input_shape[2:],
+                             dtype=np.float32)
+        self.out = np.empty((n,) + self.output_shape, dtype=np.float32)
+
+    def forward(self, x, n):
+        ho, wo, f = self.output_shape
+        sn, sh, sw, sc = x.strides
+        windows = as_strided(x, shape=self.cols[:n].shape,
+                             strides=(sn, sh*self.stride[0], sw*self.stride[1], sh, sw, sc),
+                             writeable=False)
+        cols = self.cols[:n]
+        np.copyto(cols, windows)
+
+        out = self.out[:n]
+        self.matmul(cols.reshape(n*ho*wo, -1), out.reshape(n*ho*wo, f))
+        out += self.b
+        if self.activation is not None:
+            self.activation(out)
+        return out
+
+
+class Flatten(Layer):
+    def __init__(self, name, input_shape):
+        Layer.__init__(self, name, input_shape)
+        self.output_shape = (int(np.prod(self.input_shape)),)
+
+    def forward(self, x, n):
+        return x.reshape(n, -1)
+
+
+class Dense(Layer):
+    n_weights = 2
+
+    def __init__(self, name, input_shape, units, activation_name):
+        Layer.__init__(self, name, input_shape)
+        self.output_shape = (units,)
+        self.activation = activation(activation_name)
+
+    def set_weights(self, weights):
+        W, b = weights
+        self.W = np.ascontiguousarray(W, dtype=np.float32)
+        self.b = np.asarray(b, dtype=np.float32)
+
+    def matmul(self, a, out):
+        np.dot(a, self.W, out=out)
+
+    def allocate(self, n):
+        self.out = np.empty((n,) + self.output_shape, dtype=np.float32)
+
+    def forward(self, x, n):
+        out = self.out[:n]
+        self.matmul(x, out)
+        out += self.b
+        if self.activation is not None:
+            self.activation(out)
+        return out
+
+
+class Activation(Layer):
+    def __init__(self, name, input_shape, activation_name, alpha=None):
+        Layer.__init__(self, name, input_shape)
+        self.activation = activation(activation_name, alpha)
+
+    def forward(self, x, n):
+        if self.activation is not None:
+            self.activation(x)
+        return x
+
+
+def build_layers(config, conv_class=Conv2D, dense_class=Dense):
+    """
+    Builds the layers of a Sequential model from its Keras 1 json config.
+
+    conv_class, dense_class : layer classes to use for convolutions and
+                              dense layers, e.g. quantized variants
+    """
+    if isinstance(config, dict):
+        config = config['layers']
+
+    layers = []
+    shape = None
+    for layer in config:
+        kind, cfg = layer['class_name'], layer['config']
+        name = cfg['name']
+        if shape is None:
+            shape = cfg['batch_input_shape'][1:]
+
+        if kind == 'Lambda':
+            layers.append(Normalize(name, shape))
+        elif kind == 'Convolution2D':
+            if cfg.get('border_mode', 'valid') != 'valid':
+                raise ValueError('%s: only valid convolutions are supported' % name)
+            if cfg.get('dim_ordering', 'tf') != 'tf':
+                raise ValueError('%s: only tf dim ordering is supported' % name)
+            layers.append(conv_class(name, shape, cfg['nb_filter'], cfg['nb_row'],
+                                     cfg['nb_col'], cfg.get('subsample', (1, 1)),
+                                     cfg.get('activation', 'linear')))
+        elif kind == 'Flatten':
+            layers.append(Flatten(name, shape))
+        elif kind == 'Dense':
+            layers.append(dense_class(name, shape, cfg['output_dim'],
+                                      cfg.get('activation', 'linear')))
+        elif kind == 'Activation':
+            layers.append(Activation(name, shape, cfg['activation']))
+        elif kind == 'ELU':
+            layers.append(Activation(name, shape, 'elu', cfg.get('alpha', 1.)))
+        elif kind == 'Dropout':
+            layers.append(Layer(name, shape)) # No-op at inference time
+        else:
+            raise ValueError('Unsupported layer %s (%s)' % (name, kind))
+        shape = layers[-1].output_shape
+    return layers
+
+
+class NumpyEngine(object):
+    def __init__(self, layers):
+        self.layers = layers
+        self.input_shape = layers[0].input_shape
+        self.capacity = 0 # Largest batch the buffers can hold
+
+    @classmethod
+    def from_json(cls, json_path, weights_file=None):
+        """
+        Builds the engine from a model json and its weights, by default the
+        .h5 file stored next to the json.
+        """
+        with open(json_path, 'r') as jfile:
+            engine = cls(build_layers(json.load(jfile)['config']))
+
+        weights = dict(read_layer_weights(weights_file or weights_path(json_path)))
+        for layer in engine.layers:
+            if layer.n_weights:
+                layer.set_weights(weights[layer.name])
+        return engine
+
+    def set_weights(self, weights):
+        """
+        Sets the weights from a flat list in the order of model.get_weights().
+        """
+        weights = list(weights)
+        for layer in self.layers:
+            if layer.n_weights:
+                layer.set_weights(weights[:layer.n_weights])
+                weights = weights[layer.n_weights:]
+
+    def allocate(self, n):
+        for layer in self.layers:
+            layer.allocate(n)
+        self.capacity = n
+
+    def predict_batch(self, images):
+        """
+        Returns the model outputs for a batch of preprocessed images.
+        """
+        n = len(images)
+        if n > self.capacity:
+            self.allocate(n)
+        x = images
+        for layer in self.layers:
+            x = layer.forward(x, n)
+        return x[:, 0].copy()
+
+    def predict(self, image):
+        """
+        Returns the model output for a single preprocessed image as a float.
+        """
+        return float(self.predict_batch(image[None])[0])
+
+    def warmup(self, n=3):
+        x = np.zeros((1,) + self.input_shape, dtype=np.float32)
+        for i in range(n):
+            self.predict_batch(x)
+
+
+def load_engine(json_path):
+    """
+    Returns a warmed-up engine for the model json, for use with ModelLoader.
+    """
+    engine = NumpyEngine.from_json(json_path)
+    engine.warmup()
+    return engine
+
+
+def time_predictions(engine, frames, batch_size):
+    outputs = []
+    latencies = []
+    for i in range(0, len(frames), batch_size):
+        t0 = time.perf_counter()
+        outputs.append(engine.predict_batch(frames[i:i + batch_size]))
+        latencies.append(time.perf_counter() - t0)
+    return np.concatenate(outputs), latencies
+
+
+if __name__ == '__main__':
+    from replay import latency_stats
+
+    parser = argparse.ArgumentParser(description='Benchmark the NumPy inference engine')
+    parser.add_argument('model', type=str,
+        help='Path to model definition json. Model weights should be on the same path.')
+    parser.add_argument('--data', type=str, default=None,
+        help='Dataset directory (live_data) to take frames from instead of random images.')
+    parser.add_argument('--frames', type=int, default=200,
+        help='Number of frames to predict.')
+    parser.add_argument('--batch', type=int, default=1,
+        help='Frames per prediction.')
+    parser.add_argument('--compare', action='store_true',
+        help='Also run the Keras model and compare outputs and latency.')
+    parser.add_argument('--tolerance', type=float, default=1e-4,
+        help='Largest allowed difference to the Keras output with --compare.')
+    args = parser.parse_args()
+
+    if args.data:
+        from dataset_store import DatasetReader
+        reader = DatasetReader(args.data)
+        frames = reader.read(max(0, len(reader) - args.frames), len(reader))[0]
+    else:
+        frames = np.random.RandomState(0).randint(0, 256, (args.frames, 66, 200, 3)).astype(np.uint8)
+
+    t0 = time.time()
+    engine = load_engine(args.model)
+    print('numpy engine ready after %0.2f s' % (time.time() - t0))
+    results = [('numpy',) + time_predictions(engine, frames, args.batch)]
+
+    if args.compare:
+        t0 = time.time()
+        from hybrid_driver import load_model
+        from inference import InferenceEngine
+        keras_engine = InferenceEngine(load_model(args.model))
+        keras_engine.warmup()
+        print('keras engine ready after %0.2f s' % (time.time() - t0))
+        results.append(('keras',) + time_predictions(keras_engine, frames, args.batch))
+
+    for name, outputs, latencies in results:
+        lat = latency_stats(latencies)
+        print('%-6s batch %d  mean %.2f  p50 %.2f  p95 %.2f  p99 %.2f ms' %
+              (name, args.batch, lat['mean'], lat['p50'], lat['p95'], lat['p99']))
+
+    if args.compare:
+        error = np.abs(results[0][1] - results[1][1]).max()
+        print('max abs difference to keras: %g (tolerance %g)' % (error, args.tolerance))
+        if error > args.tolerance:
+            raise SystemExit(1)
@@ -0,0 +1,264 @@
+"""
+Offline training over everything recorded during live training
+
+Trains a model on one or more live_data datasets (see dataset_store.py)
+and/or telemetry logs recorded with --record, streaming samples from disk so
+that the amount of data is limited by disk space rather than memory:
+
+    python offline_trainer.py model_5.json live_data session1.log --epochs 5
+
+Samples are read in chunks by a pool of worker threads. Dataset chunks are
+memory-mapped slices. Log frames are decoded like the server decodes them
+(PIL by default, OpenCV with --fast-decode) and preprocessed with
+`LiveTrainer.preprocess_input`, so the model is trained on the same input it
+drives on.
+Training batches are drawn at random from a shuffle buffer that the chunks
+stream through. A fraction of the chunks is held out and used to validate the
+model after every epoch, and the weights with the best validation loss are
+saved.
+"""
+__author__ = 'Thomas Antony'
+
+import os
+import queue
+import argparse
+import threading
+from functools import partial
+
+import numpy as np
+
+import live_trainer
+from live_trainer import LiveTrainer
+from server import decode_image_bytes
+from dataset_store import DatasetReader
+from telemetry_log import index_telemetry_log, read_telemetry_records
+
+
+def read_dataset_chunk(reader, start, stop):
+    images, labels = reader.read(start, stop)[:2]
+    return np.array(images), np.array(labels, dtype=np.float32)
+
+
+def read_log_chunk(path, offset, count, decode_mode='pil'):
+    images = []
+    labels = np.empty(count, dtype=np.float32)
+    for received, steering_angle, throttle, speed, jpeg in read_telemetry_records(path, offset, count):
+        img = decode_image_bytes(jpeg, decode_mode)
+        labels[len(images)] = steering_angle
+        images.append(LiveTrainer.preprocess_input(img))
+    return np.stack(images), labels[:len(images)]
+
+
+def find_chunks(path, chunk_size, decode_mode='pil'):
+    """
+    Returns a list of (number of samples, task) for a dataset directory or a
+    telemetry log, where task() -> (images, labels) reads one chunk.
+
+    decode_mode : how log frames are decoded, see ControlServer
+    """
+    chunks = []
+    if os.path.isdir(path):
+        reader = DatasetReader(path)
+        for start in range(0, len(reader), chunk_size):
+            stop = min(start + chunk_size, len(reader))
+            chunks.append((stop - start, partial(read_dataset_chunk, reader, start, stop)))
+    else:
+        offsets = index_telemetry_log(path)
+        for i in range(0, len(offsets), chunk_size):
+            count = min(chunk_size, len(offsets) - i)
+            chunks.append((count, partial(read_log_chunk, path, offsets[i], count,
+                                          decode_mode)))
+    return chunks
+
+
+def prefetch(tasks, workers=4, max_chunks=8):
+    """
+    Runs the tasks in worker threads and yields their results in the order
+    they complete. At most max_chunks results are held in memory.
+    """
+    todo = queue.Queue()
+    for task in tasks:
+        todo.put(task)
+    done = queue.Queue(maxsize=max_chunks)
+    stop = threading.Event()
+
+    def work():
+        while not stop.is_set():
+            try:
+                task = todo.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                done.put(task())
+            except Exception as e:
+                done.put(e)
+        done.put(None)
+
+    threads = [threading.Thread(target=work, name='prefetch-%d' % i) for i in range(workers)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    try:
+        finished = 0
+        while finished < workers:
+            item = done.get()
+            if item is None:
+                finished += 1
+            elif isinstance(item, Exception):
+                raise item
+            else:
+                yield item
+    finally:
+        # Stop the workers if the consumer quits early
+        stop.set()
+        while any(thread.is_alive() for thread in threads):
+            try:
+                done.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+
+def shuffled_batches(chunks, batch_size, buffer_size, rng=np.random):
+    """
+    Streams (images, labels) chunks through a shuffle buffer and yields
+    batches drawn from it at random.
+    """
+    X = y = None
+    n = 0
+    for images, labels in chunks:
+        if X is None:
+            X = np.empty((buffer_size,) + images.shape[1:], dtype=images.dtype)
+            y = np.empty(buffer_size, dtype=np.float32)
+        i = 0
+        while i < len(images):
+            count = min(buffer_size - n, len(images) - i)
+            X[n:n + count] = images[i:i + count]
+            y[n:n + count] = labels[i:i + count]
+            n += count
+            i += count
+
+            if n < buffer_size:
+                continue
+
+            # Drain half of the full buffer. The samples at the end of the
+            # buffer are moved into the slots of the drawn ones.
+            while n > buffer_size//2:
+                idx = rng.choice(n, batch_size, replace=False)
+                yield X[idx], y[idx]
+                holes = idx[idx < n - batch_size]
+                keep = np.setdiff1d(np.arange(n - batch_size, n), idx)
+                X[holes] = X[keep]
+                y[holes] = y[keep]
+                n -= batch_size
+
+    # Remaining samples in random order
+    if n:
+        order = rng.permutation(n)
+        for start in range(0, n, batch_size):
+            idx = order[start:start + batch_size]
+            yield X[idx], y[idx]
+
+
+def training_generator(chunks, batch_size, buffer_size, workers):
+    """
+    Endless generator of shuffled training batches for fit_generator.
+    """
+    while True:
+        tasks = [task for size, task in chunks]
+        np.random.shuffle(tasks)
+        for batch in shuffled_batches(prefetch(tasks, workers), batch_size, buffer_size):
+            yield batch
+
+
+def validation_generator(chunks, batch_size, workers):
+    """
+    Endless generator of validation batches for fit_generator.
+    """
+    while True:
+        for images, labels in prefetch([task for size, task in chunks], workers):
+            for start in range(0, len(images), batch_size):
+                yield images[start:start + batch_size], labels[start:start + batch_size]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Offline training on recorded data')
+    parser.add_argument('model', type=str,
+        help='Path to model definition json. Model weights on the same path are loaded if present.')
+    parser.add_argument('data', type=str, nargs='+',
+        help='Dataset directories (live_data) and/or telemetry logs recorded with --record.')
+    parser.add_argument('--epochs', type=int, default=5,
+        help='Number of epochs.')
+    parser.add_argument('--epoch-samples', type=int, default=None,
+        help='Training samples per epoch, i.e. between validations (default: all).')
+    parser.add_argument('--batch-size', type=int, default=64,
+        help='Training batch size.')
+    parser.add_argument('--lr', type=float, default=1e-4,
+        help='Learning rate.')
+    parser.add_argument('--validation', type=float, default=0.1,
+        help='Fraction of chunks held out for validation.')
+    parser.add_argument('--workers', type=int, default=4,
+        help='Threads reading and preprocessing chunks.')
+    parser.add_argument('--chunk-size', type=int, default=256,
+        help='Samples read per chunk.')
+    parser.add_argument('--shuffle-buffer', type=int, default=2048,
+        help='Samples held in the shuffle buffer.')
+    parser.add_argument('--output', type=str, default='./offline.h5',
+        help='File the weights with the best validation loss are saved to.')
+    parser.add_argument('--seed', type=int, default=0,
+        help='Seed for the validation split.')
+    parser.add_argument('--fast-decode', action='store_true',
+        help='Decode log frames with OpenCV into uint8 like the drivers with --fast-decode.')
+    args = parser.parse_args()
+
+    if args.shuffle_buffer < 2*args.batch_size:
+        parser.error('--shuffle-buffer must be at least twice --batch-size')
+
+    chunks = []
+    for path in args.data:
+        chunks.extend(find_chunks(path, args.chunk_size,
+                                  'fast' if args.fast_decode else 'pil'))
+
+    # Hold out whole chunks, so that validation frames are not neighbours of
+    # training frames
+    order = np.random.RandomState(args.seed).permutation(len(chunks))
+    n_val = int(round(len(chunks)*args.validation))
+    val_chunks = [chunks[i] for i in order[:n_val]]
+    train_chunks = [chunks[i] for i in order[n_val:]]
+    n_train = sum(size for size, task in train_chunks)
+    n_val_samples = sum(size for size, task in val_chunks)
+    if n_train == 0:
+        parser.error('No training samples found')
+    print('%d training and %d validation samples in %d chunks' %
+          (n_train, n_val_samples, len(chunks)))
+
+    from keras.callbacks import ModelCheckpoint
+
+    live_trainer.learning_rate = args.lr
+    model = live_trainer.load_model(args.model)
+
+    callbacks = []
+    validation = {}
+    if n_val_samples:
+        validation = {'validation_data': validation_generator(val_chunks, args.batch_size, args.workers),
+                      'nb_val_samples': n_val_samples}
+        callbacks.append(ModelCheckpoint(args.output, monitor='val_loss', verbose=1,
+                                         save_best_only=True, save_weights_only=True))
+    else:
+        callbacks.append(ModelCheckpoint(args.output, monitor='loss', verbose=1,
+                                         save_best_only=True, save_weights_only=True))
+
+    samples_per_epoch = args.epoch_samples or n_train
+    samples_per_epoch -= samples_per_epoch % args.batch_size
+    train_batches = training_generator(train_chunks, args.batch_size,
+                                       args.shuffle_buffer, args.workers)
+    model.fit_generator(train_batches,
+        samples_per_epoch=max(samples_per_epoch, args.batch_size),
+        nb_epoch=args.epochs,
+        callbacks=callbacks,
+        **validation)
+
+    # Stop the prefetch threads
+    train_batches.close()
+    if n_val_samples:
+        validation['validation_data'].close()
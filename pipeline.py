@@ -0,0 +1,173 @@
+"""
+Pipelined frame handling
+
+Without a pipeline, every frame is decoded, preprocessed, run through the
+model and answered in one go before the next frame is looked at.
+`FramePipeline` splits this into three stages connected by bounded queues:
+
+    decode      base64 and JPEG decoding                 (eventlet.tpool thread)
+    preprocess  the driver's preprocess_input, e.g. crop (eventlet.tpool thread)
+    drive       the driver callbacks, i.e. inference and send_control (hub)
+
+Each stage is a greenthread that handles one frame at a time, so frames stay
+in order. OpenCV, PIL and TensorFlow release the GIL, so frame t+1 is decoded
+and preprocessed in a native thread while the model runs on frame t. A full
+queue blocks the stage in front of it, and new frames wait on the socket.
+
+A callback that has `preprocess_input(image)` gets its result as
+telemetry['x']. With 'latest' scheduling, a stage skips a frame if a newer
+frame of the same simulator is already waiting behind it, so stale frames are
+not worked on and the car is steered with the newest one.
+
+For every stage, the time frames wait in its queue ('pipeline_<stage>_wait')
+and the time spent on them ('pipeline_<stage>') are recorded as latency
+histograms. /metrics also reports the current queue length and the fraction
+of time each stage was busy.
+"""
+__author__ = 'Thomas Antony'
+
+import time
+import traceback
+from collections import Counter
+
+import eventlet
+from eventlet import tpool
+from eventlet.queue import Queue
+
+from server import decode_frame
+
+
+class Frame(object):
+    def __init__(self, session, data, received):
+        self.session = session
+        self.data = data            # Raw telemetry
+        self.received = received    # time.time() the frame arrived
+        self.t0 = time.perf_counter()
+        self.telemetry = None       # Decoded telemetry, handed to callbacks
+        self.base64_time = None
+        self.image_time = None
+        self.decode_time = None
+
+
+class Stage(object):
+    def __init__(self, name, work, depth, in_thread=True, skip_stale=False):
+        """
+        name       : stage name used in the metrics
+        work       : work(frame), run on every frame
+        depth      : number of frames that can wait in the input queue
+        in_thread  : if True, work runs in a native thread (eventlet.tpool),
+                     otherwise on the hub
+        skip_stale : if True, a frame is dropped when a newer frame of the
+                     same session is waiting in the queue
+        """
+        self.name = name
+        self.work = work
+        self.depth = depth
+        self.in_thread = in_thread
+        self.skip_stale = skip_stale
+        self.queue = Queue(depth)
+        self.waiting = Counter() # Queued frames of each session
+
+        self.started = time.time()
+        self.busy_time = 0.
+        self.frames = 0
+
+    def put(self, frame):
+        """
+        Queues a frame. Blocks the calling greenthread while the queue is full.
+        """
+        self.waiting[frame.session.sid] += 1
+        self.queue.put((frame, time.perf_counter()))
+
+    def run(self, server, forward=None):
+        """
+        Stage greenthread. forward(frame) passes handled frames on.
+        """
+        metrics = server.metrics
+        while True:
+            frame, queued = self.queue.get()
+            t0 = time.perf_counter()
+            metrics.observe('pipeline_%s_wait' % self.name, t0 - queued)
+
+            sid = frame.session.sid
+            self.waiting[sid] -= 1
+            if not self.waiting[sid]:
+                del self.waiting[sid]
+            elif self.skip_stale:
+                server.drop_frame(frame.session)
+                continue
+            try:
+                if self.in_thread:
+                    tpool.execute(self.work, frame)
+                else:
+                    self.work(frame)
+            except Exception:
+                traceback.print_exc()
+                metrics.increment('pipeline_errors')
+                continue
+            finally:
+                elapsed = time.perf_counter() - t0
+                self.busy_time += elapsed
+                self.frames += 1
+                metrics.observe('pipeline_' + self.name, elapsed)
+
+            if forward is not None:
+                forward(frame)
+
+    def stats(self):
+        return {'queued': self.queue.qsize(),
+                'depth': self.depth,
+                'busy': self.busy_time/max(time.time() - self.started, 1e-6),
+                'frames': self.frames}
+
+
+class FramePipeline(object):
+    def __init__(self, server, depth=2):
+        """
+        server : ControlServer the frames come from
+        depth  : number of frames that can wait in front of each stage
+        """
+        self.server = server
+        latest = server.scheduling == 'latest'
+        self.decode_stage = Stage('decode', self.decode, depth, skip_stale=latest)
+        self.preprocess_stage = Stage('preprocess', self.preprocess, depth, skip_stale=latest)
+        self.drive_stage = Stage('drive', self.drive, depth, in_thread=False,
+                                 skip_stale=latest)
+        self.stages = [self.decode_stage, self.preprocess_stage, self.drive_stage]
+
+    def start(self):
+        server = self.server
+        eventlet.spawn_n(self.decode_stage.run, server, self.preprocess_stage.put)
+        eventlet.spawn_n(self.preprocess_stage.run, server, self.drive_stage.put)
+        eventlet.spawn_n(self.drive_stage.run, server)
+
+    def put(self, session, data, received):
+        self.decode_stage.put(Frame(session, data, received))
+
+    def stats(self):
+        return dict((stage.name, stage.stats()) for stage in self.stages)
+
+    def decode(self, frame):
+        t0 = time.perf_counter()
+        frame.telemetry, frame.base64_time, frame.image_time = decode_frame(
+            frame.data, self.server.decode_mode)
+        frame.telemetry['sid'] = frame.session.sid
+        frame.decode_time = time.perf_counter() - t0
+
+    def preprocess(self, frame):
+        telemetry = frame.telemetry
+        for cb in self.server.callbacks:
+            if hasattr(cb, 'preprocess_input'):
+                t0 = time.perf_counter()
+                telemetry['x'] = cb.preprocess_input(telemetry['image'])
+                telemetry['preprocess_time'] = time.perf_counter() - t0
+                break
+
+    def drive(self, frame):
+        metrics = self.server.metrics
+        metrics.observe('base64_decode', frame.base64_time)
+        metrics.observe('image_decode', frame.image_time)
+        if 'preprocess_time' in frame.telemetry:
+            metrics.observe('preprocess', frame.telemetry['preprocess_time'])
+        self.server.dispatch_telemetry(frame.session, frame.telemetry, frame.received,
+                                       frame.t0, frame.decode_time)
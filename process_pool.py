@@ -0,0 +1,156 @@
+"""
+Model inference in worker processes
+
+TensorFlow calls block the whole eventlet hub while they run. `InferencePool`
+runs the model in separate processes instead. Every worker owns a pair of
+shared-memory buffers for its input frames and outputs, so only a frame count
+goes through the worker's pipe. The calling greenthread waits on the pipe
+with eventlet's trampoline, which lets the hub serve other greenthreads in
+the meantime.
+
+The pool has the same predict/predict_batch interface as InferenceEngine.
+"""
+__author__ = 'Thomas Antony'
+
+import multiprocessing
+from multiprocessing import shared_memory
+
+import numpy as np
+from eventlet.hubs import trampoline
+from eventlet.queue import LightQueue
+from eventlet.semaphore import Semaphore
+
+
+def worker_main(load_fn, input_name, output_name, input_shape, conn):
+    """
+    Entry point of a worker process.
+    """
+    from inference import InferenceEngine
+
+    shm_in = shared_memory.SharedMemory(name=input_name)
+    shm_out = shared_memory.SharedMemory(name=output_name)
+    x = np.ndarray(input_shape, dtype=np.float32, buffer=shm_in.buf)
+    y = np.ndarray(input_shape[:1], dtype=np.float32, buffer=shm_out.buf)
+
+    model = load_fn()
+    engine = InferenceEngine(model)
+    engine.warmup()
+    conn.send('ready')
+
+    while True:
+        msg = conn.recv()
+        if msg is None:
+            break
+        command, arg = msg
+        if command == 'predict':
+            y[:arg] = engine.predict_batch(x[:arg])
+            conn.send(arg)
+        elif command == 'weights':
+            model.set_weights(arg)
+            conn.send(0)
+
+    del x, y
+    shm_in.close()
+    shm_out.close()
+
+
+class Worker(object):
+    def __init__(self, ctx, load_fn, input_shape, max_batch):
+        shape = (max_batch,) + tuple(input_shape)
+        self.shm_in = shared_memory.SharedMemory(create=True, size=int(np.prod(shape))*4)
+        self.shm_out = shared_memory.SharedMemory(create=True, size=max_batch*4)
+        self.x = np.ndarray(shape, dtype=np.float32, buffer=self.shm_in.buf)
+        self.y = np.ndarray((max_batch,), dtype=np.float32, buffer=self.shm_out.buf)
+
+        self.conn, child_conn = ctx.Pipe()
+        self.process = ctx.Process(target=worker_main, name='inference-worker',
+                                   args=(load_fn, self.shm_in.name, self.shm_out.name,
+                                         shape, child_conn))
+        self.process.daemon = True
+        self.process.start()
+
+        self.lock = Semaphore(1) # Held by the greenthread using the worker
+
+    def wait_ready(self):
+        try:
+            ready = self.conn.recv()
+        except EOFError:
+            ready = None
+        if ready != 'ready':
+            raise RuntimeError('Inference worker failed to start')
+
+    def call(self, command, arg):
+        """
+        Sends a command and cooperatively waits for the reply.
+        """
+        self.conn.send((command, arg))
+        trampoline(self.conn.fileno(), read=True)
+        return self.conn.recv()
+
+    def close(self):
+        try:
+            self.conn.send(None)
+        except (OSError, EOFError):
+            pass
+        self.process.join(1)
+        self.shm_in.close()
+        self.shm_in.unlink()
+        self.shm_out.close()
+        self.shm_out.unlink()
+
+
+class InferencePool(object):
+    def __init__(self, load_fn, n_workers=2, input_shape=(66, 200, 3), max_batch=32):
+        """
+        load_fn   : picklable load_fn() -> model, run in every worker process
+        n_workers : number of worker processes
+        max_batch : largest batch that can be passed to predict_batch
+        """
+        self.max_batch = max_batch
+
+        # Workers must not inherit the parent's TensorFlow state
+        ctx = multiprocessing.get_context('spawn')
+        self.workers = [Worker(ctx, load_fn, input_shape, max_batch)
+                        for i in range(n_workers)]
+        try:
+            for worker in self.workers:
+                worker.wait_ready()
+        except RuntimeError:
+            self.close()
+            raise
+
+        self.idle = LightQueue()
+        for worker in self.workers:
+            self.idle.put(worker)
+
+    def predict_batch(self, images):
+        n = len(images)
+        if n > self.max_batch:
+            raise ValueError('Batch of %d exceeds max_batch %d' % (n, self.max_batch))
+
+        worker = self.idle.get()
+        try:
+            with worker.lock:
+                np.copyto(worker.x[:n], images, casting='unsafe')
+                worker.call('predict', n)
+                return worker.y[:n].copy()
+        finally:
+            self.idle.put(worker)
+
+    def predict(self, image):
+        return float(self.predict_batch(image[None])[0])
+
+    def warmup(self, n=3):
+        pass # Workers warm up before reporting ready
+
+    def set_weights(self, weights):
+        """
+        Copies new weights into every worker, waiting for each to go idle.
+        """
+        for worker in self.workers:
+            with worker.lock:
+                worker.call('weights', weights)
+
+    def close(self):
+        for worker in self.workers:
+            worker.close()
@@ -0,0 +1,200 @@
+"""
+On-demand CPU profiling of a running driver
+
+`Profiler.start(seconds)` captures a profile for a fixed time while the car
+keeps driving. It is triggered with the `p` key in the drivers or over HTTP:
+
+    curl 'http://localhost:4567/profile?seconds=10'
+    curl 'http://localhost:4567/profile?seconds=10&mode=cprofile'
+
+In 'sample' mode (the default) a background thread samples the Python stack
+of every thread every few milliseconds. Each sample is attributed to a
+category. On the server thread, the innermost frame that belongs to a known
+handler, matched by file and function name, decides the category, because
+all greenthreads share that OS thread. Threads started by the drivers are
+categorised by their name. The samples are written as collapsed stacks
+(`category;thread;outer;...;inner count` per line), which flamegraph.pl and
+speedscope read directly. A summary per category is printed.
+
+In 'cprofile' mode the server thread, with all of its greenthreads, runs
+under cProfile and the stats are dumped to a .prof file.
+
+Nothing runs while no capture is active.
+"""
+__author__ = 'Thomas Antony'
+
+import os
+import sys
+import time
+import cProfile
+import threading
+from collections import Counter
+
+import eventlet
+
+# Innermost frame matching one of these functions decides the category of a
+# server-thread sample. Functions are matched with their file, as generic
+# names such as predict and flush are defined in several modules.
+categories = [
+    ('inference', {
+        'hybrid_driver.py': ('predict_steering',),
+        'live_trainer.py': ('predict_steering',),
+        'inference.py': ('predict', 'predict_batch'),
+        'batch_predictor.py': ('predict', 'flush'),
+        'numpy_engine.py': ('predict', 'predict_batch'),
+        'process_pool.py': ('predict', 'predict_batch'),
+    }),
+    ('training', {
+        'live_trainer.py': ('process_data', 'train_model', 'save_batch'),
+        'training_worker.py': ('apply_updates',),
+    }),
+    ('ui', {
+        'status_window.py': ('main_loop', 'pump', 'refresh'),
+        'manual_driver.py': ('render_status', 'update_status'),
+        'hybrid_driver.py': ('render_status', 'update_status'),
+        'live_trainer.py': ('render_status', 'update_status'),
+    }),
+    ('telemetry', {
+        'server.py': ('on_telemetry', 'process_telemetry', 'drain_session',
+                      'decode_telemetry', 'decode_image', 'send_control',
+                      'decode_frame', 'dispatch_telemetry'),
+        'manual_driver.py': ('handle_telemetry',),
+        'hybrid_driver.py': ('handle_telemetry',),
+        'live_trainer.py': ('handle_telemetry',),
+        'drive.py': ('telemetry', 'send_control'),
+    }),
+]
+
+# (file, function) -> category
+function_categories = dict(((filename, function), category)
+                           for category, files in categories
+                           for filename, functions in files.items()
+                           for function in functions)
+
+thread_categories = {
+    'training-worker': 'training',
+    'augmentation': 'training',
+    'checkpoint-writer': 'training',
+    'dataset-writer': 'training',
+    'model-loader': 'loading',
+    'weight-watcher': 'loading',
+    'asyncio-server': 'telemetry',
+    'decode': 'telemetry',
+    'tpool_thread': 'telemetry', # Frame pipeline stages
+}
+
+
+def frame_names(frame):
+    """
+    Returns the stack of a frame as a list of 'function (file:line)', outermost
+    first.
+    """
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append('%s (%s:%d)' % (code.co_name, os.path.basename(code.co_filename),
+                                     frame.f_lineno))
+        frame = frame.f_back
+    names.reverse()
+    return names
+
+
+def categorize(frame, thread_name):
+    if os.path.basename(frame.f_code.co_filename) in ('threading.py', 'queue.py'):
+        return 'idle' # Blocked waiting for work
+    pool = thread_name.rsplit('_', 1)[0] # Pool threads are named prefix_N
+    if pool in thread_categories:
+        return thread_categories[pool]
+    while frame is not None:
+        code = frame.f_code
+        category = function_categories.get((os.path.basename(code.co_filename),
+                                            code.co_name))
+        if category is not None:
+            return category
+        frame = frame.f_back
+    return 'idle' if thread_name == 'MainThread' else 'other'
+
+
+class Profiler(object):
+    def __init__(self, output_dir='./profiles', interval=0.005):
+        """
+        output_dir : directory profiles are written to
+        interval   : seconds between samples in 'sample' mode
+        """
+        self.output_dir = output_dir
+        self.interval = interval
+        self.active = None # Path of the capture in progress
+        self.lock = threading.Lock()
+
+    def start(self, seconds=10., mode='sample'):
+        """
+        Starts a capture unless one is running. Returns the path the profile
+        will be written to, or None if a capture is already running.
+        """
+        if mode not in ('sample', 'cprofile'):
+            raise ValueError('Unknown profiler mode: %s' % mode)
+
+        with self.lock:
+            if self.active is not None:
+                return None
+            if not os.path.isdir(self.output_dir):
+                os.makedirs(self.output_dir)
+            stamp = time.strftime('%Y%m%d-%H%M%S')
+            ext = '.collapsed' if mode == 'sample' else '.prof'
+            self.active = os.path.join(self.output_dir, 'profile-%s%s' % (stamp, ext))
+
+        print('Profiling for %g s (%s) ...' % (seconds, mode))
+        if mode == 'sample':
+            thread = threading.Thread(target=self.sample, name='profiler',
+                                      args=(seconds, self.active, threading.get_ident()))
+            thread.daemon = True
+            thread.start()
+        else:
+            # Called on the server thread, so all of its greenthreads are
+            # profiled
+            profile = cProfile.Profile()
+            profile.enable()
+            eventlet.spawn_after(seconds, self.stop_cprofile, profile, self.active)
+        return self.active
+
+    def sample(self, seconds, path, server_thread):
+        names = {}
+        stacks = Counter()
+        own = threading.get_ident()
+
+        end = time.time() + seconds
+        while time.time() < end:
+            for thread in threading.enumerate():
+                names[thread.ident] = thread.name
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                thread_name = names.get(ident, str(ident))
+                if ident == server_thread:
+                    thread_name = 'MainThread'
+                category = categorize(frame, thread_name)
+                stacks[';'.join([category, thread_name] + frame_names(frame))] += 1
+            time.sleep(self.interval)
+
+        with open(path, 'w') as f:
+            for stack, count in stacks.most_common():
+                f.write('%s %d\n' % (stack, count))
+        self.finish(path, stacks)
+
+    def stop_cprofile(self, profile, path):
+        profile.disable()
+        profile.dump_stats(path)
+        self.finish(path)
+
+    def finish(self, path, stacks=None):
+        if stacks:
+            totals = Counter()
+            for stack, count in stacks.items():
+                totals[stack.split(';', 1)[0]] += count
+            total = float(sum(totals.values()))
+            print('Profile written to %s (%s)' % (path, ', '.join(
+                '%s %.0f%%' % (c, 100*n/total) for c, n in totals.most_common())))
+        else:
+            print('Profile written to %s' % path)
+        with self.lock:
+            self.active = None
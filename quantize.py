@@ -0,0 +1,224 @@
+"""
+Post-training int8 quantization of the model_5 network
+
+Calibrates int8 scales on recorded preprocessed frames (a live_data dataset)
+and writes a quantized model next to the json:
+
+    python quantize.py model_5.json --data live_data
+
+The weights of every convolution and dense layer are quantized with one scale
+per output channel. The input to each of these layers gets a single scale,
+set from the largest activation seen on the calibration frames. The
+artifact, `<model>.int8.npz`, stores the int8 weights, their scales, the
+float biases, the activation scales and the layer config. It is about a
+quarter of the size of the float weights.
+
+The tool then runs the quantized model on held-out frames and reports its
+steering error and latency against the float model.
+
+The quantized engine computes what an int8 runtime would: each layer input
+is rounded to int8, multiplied with the int8 weights with int32
+accumulation, and rescaled once to float. Only the int8 weights are kept in
+memory. NumPy has no optimized integer matrix multiply, so this is much
+slower than the float engine. It is meant for checking the accuracy of an
+int8 deployment, not for driving.
+"""
+__author__ = 'Thomas Antony'
+
+import io
+import os
+import json
+import time
+import argparse
+
+import numpy as np
+
+from numpy_engine import NumpyEngine, Conv2D, Dense, build_layers
+
+
+def quantized_path(json_path):
+    return os.path.splitext(json_path)[0] + '.int8.npz'
+
+
+def quantize_weights(W):
+    """
+    Returns int8 weights and one float32 scale per output channel (last axis).
+    """
+    W = np.asarray(W, dtype=np.float32)
+    w_max = np.abs(W.reshape(-1, W.shape[-1])).max(axis=0)
+    scale = np.where(w_max > 0, w_max/127., 1.).astype(np.float32)
+    return np.clip(np.rint(W/scale), -127, 127).astype(np.int8), scale
+
+
+class QuantizedLayer(object):
+    """
+    Mixin for Conv2D and Dense that rounds the layer input to int8 and
+    multiplies it with int8 weights, accumulating in int32.
+    """
+    def set_weights(self, weights):
+        """
+        Quantizes float weights, e.g. from a reloaded checkpoint. The
+        calibrated input scale is kept.
+        """
+        W, b = weights
+        W_q, w_scale = quantize_weights(W)
+        self.set_quantized(W_q, w_scale, b)
+
+    def set_quantized(self, W_q, w_scale, b, x_scale=None):
+        if x_scale is not None:
+            self.x_scale = np.float32(x_scale)
+        self.W_q = np.ascontiguousarray(W_q, dtype=np.int8).reshape(-1, W_q.shape[-1])
+        self.w_scale = w_scale
+        self.b = np.asarray(b, dtype=np.float32)
+        self.out_scale = (self.x_scale*w_scale).astype(np.float32)
+
+    def allocate(self, n):
+        self.base.allocate(self, n)
+        self.scaled = np.empty((n,) + self.input_shape, dtype=np.float32)
+        self.xq = np.empty((n,) + self.input_shape, dtype=np.int8)
+        if hasattr(self, 'cols'):
+            self.cols = np.empty(self.cols.shape, dtype=np.int8) # int8 im2col
+        self.acc = np.empty((self.out.size//self.out.shape[-1], self.out.shape[-1]),
+                            dtype=np.int32)
+
+    def forward(self, x, n):
+        scaled = self.scaled[:n]
+        np.divide(x, self.x_scale, out=scaled)
+        np.rint(scaled, out=scaled)
+        np.clip(scaled, -127, 127, out=scaled)
+        xq = self.xq[:n]
+        np.copyto(xq, scaled, casting='unsafe')
+        return self.base.forward(self, xq, n)
+
+    def matmul(self, a, out):
+        acc = self.acc[:len(a)]
+        np.matmul(a, self.W_q, dtype=np.int32, out=acc)
+        np.multiply(acc, self.out_scale, out=out)
+
+
+class QuantizedConv2D(QuantizedLayer, Conv2D):
+    base = Conv2D
+
+
+class QuantizedDense(QuantizedLayer, Dense):
+    base = Dense
+
+
+def calibrate(engine, frames, batch_size=32):
+    """
+    Returns {layer name: largest absolute input value} for the convolution
+    and dense layers of a float engine, over the given frames.
+    """
+    ranges = {}
+    for i in range(0, len(frames), batch_size):
+        x = frames[i:i + batch_size]
+        n = len(x)
+        if n > engine.capacity:
+            engine.allocate(n)
+        for layer in engine.layers:
+            if isinstance(layer, (Conv2D, Dense)):
+                ranges[layer.name] = max(ranges.get(layer.name, 0.), float(np.abs(x).max()))
+            x = layer.forward(x, n)
+    return ranges
+
+
+def save_quantized(path, config, engine, ranges):
+    """
+    Writes the quantized model artifact for a float engine.
+    """
+    arrays = {'config': np.array(json.dumps(config))}
+    for layer in engine.layers:
+        if isinstance(layer, (Conv2D, Dense)):
+            W = layer.W.reshape(-1, layer.W.shape[-1])
+            arrays[layer.name + '/W_q'], arrays[layer.name + '/w_scale'] = quantize_weights(W)
+            arrays[layer.name + '/b'] = layer.b
+            arrays[layer.name + '/x_scale'] = np.float32(max(ranges[layer.name], 1e-8)/127.)
+
+    buf = io.BytesIO()
+    np.savez(buf, **arrays)
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp, 'wb') as f:
+        f.write(buf.getvalue())
+    os.replace(tmp, path)
+
+
+def load_quantized(path):
+    """
+    Returns a NumpyEngine running the quantized model artifact.
+    """
+    with np.load(path) as f:
+        engine = NumpyEngine(build_layers(json.loads(str(f['config'])),
+                                          QuantizedConv2D, QuantizedDense))
+        for layer in engine.layers:
+            if isinstance(layer, QuantizedLayer):
+                layer.set_quantized(f[layer.name + '/W_q'], f[layer.name + '/w_scale'],
+                                    f[layer.name + '/b'], f[layer.name + '/x_scale'])
+    return engine
+
+
+def weight_bytes(engine, quantized=False):
+    total = 0
+    for layer in engine.layers:
+        if isinstance(layer, (Conv2D, Dense)):
+            if quantized:
+                total += layer.W_q.nbytes + layer.w_scale.nbytes + layer.b.nbytes
+            else:
+                total += layer.W.nbytes + layer.b.nbytes
+    return total
+
+
+if __name__ == '__main__':
+    from dataset_store import DatasetReader
+    from numpy_engine import time_predictions
+    from replay import latency_stats
+
+    parser = argparse.ArgumentParser(description='Quantize a model to int8')
+    parser.add_argument('model', type=str,
+        help='Path to model definition json. Model weights should be on the same path.')
+    parser.add_argument('--data', type=str, default='./live_data',
+        help='Dataset directory with recorded preprocessed frames.')
+    parser.add_argument('--calibrate', type=int, default=500,
+        help='Number of frames used for calibration.')
+    parser.add_argument('--eval', type=int, default=500,
+        help='Number of held-out frames used to measure the steering error.')
+    parser.add_argument('--output', type=str, default=None,
+        help='Quantized model file (default <model>.int8.npz).')
+    parser.add_argument('--seed', type=int, default=0,
+        help='Seed for splitting frames into calibration and held-out sets.')
+    args = parser.parse_args()
+
+    reader = DatasetReader(args.data)
+    if len(reader) < args.calibrate + 1:
+        parser.error('%s has only %d frames' % (args.data, len(reader)))
+
+    # Frames next to each other are nearly identical, so split at random
+    images = reader.read(0, len(reader))[0]
+    order = np.random.RandomState(args.seed).permutation(len(images))
+    calibration = images[np.sort(order[:args.calibrate])]
+    held_out = images[np.sort(order[args.calibrate:args.calibrate + args.eval])]
+
+    with open(args.model, 'r') as jfile:
+        config = json.load(jfile)['config']
+    float_engine = NumpyEngine.from_json(args.model)
+
+    t0 = time.time()
+    ranges = calibrate(float_engine, calibration)
+    output = args.output or quantized_path(args.model)
+    save_quantized(output, config, float_engine, ranges)
+    print('Calibrated on %d frames in %0.2f s, wrote %s (%d bytes)' %
+          (len(calibration), time.time() - t0, output, os.path.getsize(output)))
+
+    int8_engine = load_quantized(output)
+    float_engine.warmup()
+    int8_engine.warmup()
+    y_float, float_latencies = time_predictions(float_engine, held_out, 1)
+    y_int8, int8_latencies = time_predictions(int8_engine, held_out, 1)
+
+    error = np.abs(y_int8 - y_float)
+    print('Steering error on %d held-out frames: mean %.5f  p95 %.5f  max %.5f (x25 deg: max %.3f)' %
+          (len(held_out), error.mean(), np.percentile(error, 95), error.max(), error.max()*25))
+    print('Weights: float %d bytes, int8 %d bytes' %
+          (weight_bytes(float_engine), weight_bytes(int8_engine, quantized=True)))
+    for name, latencies in (('float', float_latencies), ('int8', int8_latencies)):
+        lat = latency_stats(latencies)
+        print('%-6s mean %.2f  p50 %.2f  p95 %.2f ms' % (name, lat['mean'], lat['p50'], lat['p95']))
@@ -0,0 +1,147 @@
+"""
+Replays a recorded telemetry log through one of the drivers
+
+Runs without the simulator or a display. Steering commands are captured
+instead of being sent, and the time spent handling each frame is measured so
+that the throughput and latency of the full pipeline can be compared between
+changes.
+
+    python replay.py session.log --driver hybrid --model model_5.json
+"""
+__author__ = 'Thomas Antony'
+
+import os
+import json
+import time
+import argparse
+import tempfile
+
+import numpy as np
+
+from telemetry_log import read_telemetry_log
+
+
+class ReplaySink(object):
+    """
+    Stands in for the socket.io server and collects emitted steer commands.
+    """
+    def __init__(self):
+        self.commands = []
+
+    def emit(self, event, data=None, **kwargs):
+        self.commands.append(data)
+
+
+def make_driver(name, model_path=None, train=False, **server_options):
+    server_options['headless'] = True
+    if name == 'manual':
+        from manual_driver import ManualDriver
+        driver = ManualDriver(**server_options)
+    elif name == 'hybrid':
+        import hybrid_driver
+        driver = hybrid_driver.HybridDriver(hybrid_driver.load_model(model_path),
+                                            **server_options)
+    elif name == 'trainer':
+        import live_trainer
+        # Keep replayed data away from the real checkpoint and dataset
+        scratch = tempfile.mkdtemp(prefix='replay-')
+        live_trainer.checkpoint_filename = os.path.join(scratch, 'checkpoint.h5')
+        live_trainer.dataset_path = os.path.join(scratch, 'live_data')
+
+        driver = live_trainer.LiveTrainer(live_trainer.load_model(model_path),
+                                          **server_options)
+        if train:
+            driver.mode = 'manual'
+            driver.is_training = True
+    else:
+        raise ValueError('Unknown driver: %s' % name)
+
+    driver.control_srv.sio = ReplaySink()
+    return driver
+
+
+def replay(driver, path, realtime=False, limit=None):
+    """
+    Feeds every frame in the log to the driver. Returns per-frame latencies
+    in seconds and the total wall-clock time.
+    """
+    srv = driver.control_srv
+    latencies = []
+
+    start = time.time()
+    first = None
+    for received, data in read_telemetry_log(path):
+        if limit is not None and len(latencies) >= limit:
+            break
+
+        if realtime:
+            if first is None:
+                first = received
+            delay = (received - first) - (time.time() - start)
+            if delay > 0:
+                time.sleep(delay)
+
+        t0 = time.perf_counter()
+        srv.process_telemetry('replay', data, time.time())
+        latencies.append(time.perf_counter() - t0)
+
+    return np.array(latencies), time.time() - start
+
+
+def latency_stats(latencies):
+    """
+    Summary statistics in milliseconds of an array of latencies in seconds.
+    """
+    ms = np.asarray(latencies)*1000
+    if len(ms) == 0:
+        ms = np.zeros(1)
+    p50, p95, p99 = np.percentile(ms, [50, 95, 99])
+    return {'mean': float(ms.mean()), 'p50': float(p50), 'p95': float(p95),
+            'p99': float(p99), 'max': float(ms.max())}
+
+
+def summarize(latencies, elapsed):
+    return {'frames': len(latencies),
+            'elapsed_s': elapsed,
+            'fps': len(latencies)/elapsed if elapsed > 0 else 0.0,
+            'latency_ms': latency_stats(latencies)}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replay recorded telemetry')
+    parser.add_argument('log', type=str, help='Telemetry log recorded with --record')
+    parser.add_argument('--driver', choices=['manual', 'hybrid', 'trainer'],
+        default='hybrid', help='Driver to feed the telemetry to.')
+    parser.add_argument('--model', type=str, default=None,
+        help='Model definition json (hybrid and trainer drivers).')
+    parser.add_argument('--train', action='store_true',
+        help='Run the live trainer in manual mode with training enabled.')
+    parser.add_argument('--realtime', action='store_true',
+        help='Replay at the recorded rate instead of as fast as possible.')
+    parser.add_argument('--fast-decode', action='store_true',
+        help='Decode camera frames with OpenCV into uint8 instead of float32 with PIL.')
+    parser.add_argument('--limit', type=int, default=None,
+        help='Stop after this many frames.')
+    parser.add_argument('--json', action='store_true',
+        help='Print the results as JSON.')
+    args = parser.parse_args()
+
+    if args.driver != 'manual' and args.model is None:
+        parser.error('--model is required for the %s driver' % args.driver)
+
+    server_options = {}
+    if args.fast_decode:
+        server_options['decode_mode'] = 'fast'
+
+    driver = make_driver(args.driver, args.model, train=args.train, **server_options)
+    latencies, elapsed = replay(driver, args.log, realtime=args.realtime,
+                                limit=args.limit)
+    result = summarize(latencies, elapsed)
+
+    if args.json:
+        print(json.dumps(result, indent=2))
+    else:
+        lat = result['latency_ms']
+        print('%d frames in %.2f s (%.1f fps)' % (result['frames'], elapsed, result['fps']))
+        print('latency ms: mean %.2f  p50 %.2f  p95 %.2f  p99 %.2f  max %.2f' %
+              (lat['mean'], lat['p50'], lat['p95'], lat['p99'], lat['max']))
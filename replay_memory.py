@@ -0,0 +1,68 @@
+"""
+Fixed-capacity replay memory for live training
+
+Samples are stored in preallocated arrays that are used as a ring buffer, so
+once the memory is full the oldest samples are overwritten first. Images are
+kept exactly as the model sees them, float32 YUV by default, which has
+negative U/V values.
+"""
+__author__ = 'Thomas Antony'
+
+import numpy as np
+
+
+class ReplayMemory(object):
+    def __init__(self, capacity, image_shape=(66, 200, 3), dtype=np.float32):
+        """
+        capacity    : number of samples kept
+        image_shape : shape of one preprocessed image
+        dtype       : image dtype, that of preprocess_input's output
+        """
+        self.capacity = capacity
+        self.images = np.zeros((capacity,) + tuple(image_shape), dtype=dtype)
+        self.labels = np.zeros(capacity, dtype=np.float32)
+
+        self.size = 0       # Number of valid samples
+        self.next_index = 0 # Slot that the next sample is written to
+        self.total_added = 0
+
+    def __len__(self):
+        return self.size
+
+    def add(self, image, label):
+        """
+        Copies one sample into the memory, evicting the oldest one if full.
+        Raises TypeError if the image cannot be stored without losing values,
+        e.g. float images in a uint8 memory.
+        """
+        i = self.next_index
+        np.copyto(self.images[i], image, casting='same_kind')
+        self.labels[i] = label
+
+        self.next_index = (i + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+        self.total_added += 1
+
+    def latest_indices(self, n):
+        n = min(n, self.size)
+        return (self.next_index - 1 - np.arange(n)[::-1]) % self.capacity
+
+    def latest(self, n):
+        """
+        Returns copies of the n most recently added samples, oldest first.
+        """
+        idx = self.latest_indices(n)
+        return self.images[idx], self.labels[idx]
+
+    def sample(self, batch_size, fresh=0):
+        """
+        Returns a random minibatch (as copies) that always contains the
+        `fresh` most recent samples, topped up with uniformly drawn samples
+        from the whole memory.
+        """
+        fresh_idx = self.latest_indices(fresh)
+        n_random = max(0, min(batch_size, self.size) - len(fresh_idx))
+        random_idx = np.random.randint(0, max(self.size, 1), size=n_random)
+
+        idx = np.concatenate((fresh_idx, random_idx))
+        return self.images[idx], self.labels[idx]
@@ -9,33 +9,206 @@ from socketio import Namespace
 import eventlet
 import eventlet.wsgi
 import time
+import cv2
 from PIL import Image
 from PIL import ImageOps
-from flask import Flask, render_template
+from flask import Flask, render_template, jsonify, request
 
 from io import BytesIO
 
+from telemetry_log import TelemetryRecorder
+from drive_log import DriveLog
+from metrics import Metrics
+from profiler import Profiler
+
+class Session(object):
+    """
+    State of one connected simulator. Holds a single-slot frame buffer that
+    is used with 'latest' scheduling: a new frame replaces any frame that has
+    not been processed yet.
+    """
+    def __init__(self, sid):
+        self.sid = sid
+        self.frame = None   # (raw telemetry, time received)
+        self.busy = False   # True while a greenthread is draining the slot
+        self.processed = 0
+        self.dropped = 0
+
+        self.frame_received_time = None # Of the frame being processed
+        self.last_frame_age = None
+        self.last_control = None # (steering, throttle, send time) of this frame
+
+def decode_jpeg(jpeg):
+    """
+    Decodes JPEG bytes with OpenCV into a new RGB uint8 array. OpenCV builds
+    with IMREAD_COLOR_RGB decode to RGB directly, older ones swap the channels
+    of the decoded array in place.
+    """
+    jpeg = np.frombuffer(jpeg, dtype=np.uint8)
+    if hasattr(cv2, 'IMREAD_COLOR_RGB'):
+        return cv2.imdecode(jpeg, cv2.IMREAD_COLOR_RGB)
+    image = cv2.imdecode(jpeg, cv2.IMREAD_COLOR)
+    return cv2.cvtColor(image, cv2.COLOR_BGR2RGB, dst=image)
+
+
+def decode_image_bytes(jpeg, decode_mode):
+    """
+    Decodes the JPEG bytes of a camera frame as the drivers receive it: a
+    float32 array with PIL for decode_mode 'pil', a uint8 array with OpenCV
+    for 'fast'.
+    """
+    if decode_mode == 'fast':
+        return decode_jpeg(jpeg)
+    return np.asarray(Image.open(BytesIO(jpeg)), dtype=np.float32)
+
+
+def decode_frame(data, decode_mode):
+    """
+    Decodes raw telemetry into a new image array. Runs in decode pools and
+    pipeline threads, so it does not touch server state. Returns the
+    telemetry dict without 'sid', and the base64 and image decode times.
+    """
+    t0 = time.perf_counter()
+    jpeg = base64.b64decode(data["image"])
+    t1 = time.perf_counter()
+    image = decode_image_bytes(jpeg, decode_mode)
+
+    telemetry = {'steering_angle': float(data["steering_angle"]),
+                 'throttle': float(data["throttle"]),
+                 'speed': float(data["speed"]),
+                 'image': image}
+    return telemetry, t1 - t0, time.perf_counter() - t1
+
+
 class ControlServer(Namespace):
 
-    def __init__(self):
+    def __init__(self, decode_mode='pil', scheduling='inline', record_path=None,
+                 drive_log_path=None, pipeline=False):
+        """
+        decode_mode : 'pil'  - image is handed to callbacks as a float32 array
+                      'fast' - image is decoded with OpenCV as a uint8
+                               array, float conversion is left to the
+                               callbacks
+        scheduling  : 'inline' - every frame is processed as it arrives
+                      'latest' - only the newest frame of each session is
+                                 processed, older unprocessed frames are dropped
+        record_path : if set, raw telemetry is recorded to this file
+        drive_log_path : if set, a record of every handled frame is written
+                         to this file (see drive_log.py)
+        pipeline    : if True, frames go through a FramePipeline (pipeline.py),
+                      which decodes and preprocesses the next frames while
+                      the callbacks handle the current one
+        """
         super().__init__()
         self.sio = None
         self.callbacks = []
 
+        if decode_mode not in ('pil', 'fast'):
+            raise ValueError('Unknown decode mode: %s' % decode_mode)
+        self.decode_mode = decode_mode
+
+        if scheduling not in ('inline', 'latest'):
+            raise ValueError('Unknown scheduling mode: %s' % scheduling)
+        self.scheduling = scheduling
+        self.sessions = {}
+
+        # Age of the frame that the last steer response was computed from
+        self.last_frame_age = None
+        self.max_frame_age = 0.0
+
+        # Per-stage latencies and frame counts, served at /metrics
+        self.metrics = Metrics()
+        self.metrics.increment('frames_dropped', 0) # Reported even if zero
+
+        # On-demand CPU profiles, started from /profile or a driver key
+        self.profiler = Profiler()
+
+        self.recorder = None
+        if record_path is not None:
+            self.recorder = TelemetryRecorder(record_path)
+
+        self.drive_log = None
+        if drive_log_path is not None:
+            self.drive_log = DriveLog(drive_log_path)
+
+        self.pipeline = None
+        if pipeline:
+            from pipeline import FramePipeline
+            self.pipeline = FramePipeline(self)
+
 
     def start(self):
         self.sio = socketio.Server()
         self.sio.register_namespace(self)
-        self.app = socketio.Middleware(self.sio, Flask(__name__))
+        self.flask_app = Flask(__name__)
+        self.flask_app.add_url_rule('/metrics', 'metrics', self.serve_metrics)
+        self.flask_app.add_url_rule('/profile', 'profile', self.serve_profile)
+        self.app = socketio.Middleware(self.sio, self.flask_app)
+        if self.pipeline is not None:
+            self.pipeline.start()
         eventlet.wsgi.server(eventlet.listen(('', 4567)), self.app)
 
+    def metrics_snapshot(self):
+        metrics = self.metrics.to_dict()
+        if self.pipeline is not None:
+            metrics['pipeline'] = self.pipeline.stats()
+        return metrics
+
+    def serve_metrics(self):
+        return jsonify(self.metrics_snapshot())
+
+    def profile_request(self, seconds, mode):
+        """
+        Starts a profile for the /profile route. Returns (response, status).
+        """
+        if mode not in ('sample', 'cprofile'):
+            return {'error': 'Unknown mode: %s' % mode}, 400
+        path = self.profiler.start(seconds, mode)
+        if path is None:
+            return {'error': 'A profile is already being captured'}, 409
+        return {'seconds': seconds, 'mode': mode, 'output': path}, 200
+
+    def serve_profile(self):
+        response, status = self.profile_request(
+            request.args.get('seconds', 10., type=float),
+            request.args.get('mode', 'sample'))
+        return jsonify(response), status
+
+    def start_profile(self, seconds=10.):
+        """
+        Starts a sampling profile, e.g. from a driver key binding.
+        """
+        return self.profiler.start(seconds)
+
+    def close(self):
+        if self.recorder is not None:
+            self.recorder.close()
+        if self.drive_log is not None:
+            self.drive_log.close()
+
     def register_callback(self, cb):
         self.callbacks.append(cb)
         def unsubscribe():
             self.callbacks.remove(cb)
         return unsubscribe
 
-    def on_telemetry(self, sid, data):
+    def get_session(self, sid):
+        session = self.sessions.get(sid)
+        if session is None:
+            session = self.sessions[sid] = Session(sid)
+        return session
+
+    def decode_image(self, imgString):
+        t0 = time.perf_counter()
+        jpeg = base64.b64decode(imgString)
+        t1 = time.perf_counter()
+        image = decode_image_bytes(jpeg, self.decode_mode)
+
+        self.metrics.observe('base64_decode', t1 - t0)
+        self.metrics.observe('image_decode', time.perf_counter() - t1)
+        return image
+
+    def decode_telemetry(self, data, session):
         # The current steering angle of the car
         steering_angle = float(data["steering_angle"])
         # The current throttle of the car
@@ -43,25 +216,170 @@ class ControlServer(Namespace):
         # The current speed of the car
         speed = float(data["speed"])
         # The current image from the center camera of the car
-        imgString = data["image"]
-        image = Image.open(BytesIO(base64.b64decode(imgString)))
+        image = self.decode_image(data["image"])
+
+        return {'sid': session.sid,
+                'steering_angle': steering_angle,
+                'throttle': throttle,
+                'speed': speed,
+                'image': image}
+
+    def on_telemetry(self, sid, data):
+        received = time.time()
+        self.metrics.increment('frames_received')
+        if self.recorder is not None:
+            self.recorder.record(data, received)
+
+        if self.scheduling == 'latest':
+            self.post_frame(sid, data, received)
+        else:
+            self.process_telemetry(sid, data, received)
 
-        telemetry = {'steering_angle': steering_angle,
-                     'throttle': throttle,
-                     'speed': speed,
-                     'image': np.asarray(image, dtype=np.float32)}
+    def post_frame(self, sid, data, received):
+        session = self.get_session(sid)
+        if session.frame is not None:
+            self.drop_frame(session)
+        session.frame = (data, received)
 
+        if not session.busy:
+            session.busy = True
+            eventlet.spawn_n(self.drain_session, session)
+
+    def drain_session(self, session):
+        try:
+            while session.frame is not None:
+                data, received = session.frame
+                session.frame = None
+                self.process_telemetry(session.sid, data, received)
+                session.processed += 1
+        finally:
+            session.busy = False
+
+    def drop_frame(self, session):
+        """
+        Counts a frame that is skipped without being handled. The metrics
+        counter keeps the drops of disconnected sessions.
+        """
+        session.dropped += 1
+        self.metrics.increment('frames_dropped')
+
+    def process_telemetry(self, sid, data, received):
+        session = self.get_session(sid)
+        if self.pipeline is not None:
+            self.pipeline.put(session, data, received)
+            return
+        t0 = time.perf_counter()
+        telemetry = self.decode_telemetry(data, session)
+        self.dispatch_telemetry(session, telemetry, received, t0,
+                                time.perf_counter() - t0)
+
+    def dispatch_telemetry(self, session, telemetry, received, t0, decode_time):
+        """
+        Hands a decoded frame to the callbacks and logs it.
+
+        t0 : perf_counter() when handling of the frame started
+        """
+        session.frame_received_time = received
+        session.last_control = None
         for cb in self.callbacks:
             cb.handle_telemetry(telemetry)
 
+        session.frame_received_time = None
+        if self.drive_log is not None:
+            self.log_frame(session, telemetry, received, decode_time,
+                           time.perf_counter() - t0)
+
+    def log_frame(self, session, telemetry, received, decode_time, total_time):
+        """
+        Writes the drive log record of a frame. Drivers can add 'mode',
+        'training', 'predicted_steering', 'preprocess_time' and
+        'predict_time' to the telemetry dict they are given.
+        """
+        steering, throttle, send_time = session.last_control or (float('nan'), float('nan'), None)
+        self.drive_log.record(received, session.sid, telemetry.get('mode'),
+                              telemetry.get('training', False),
+                              telemetry.get('predicted_steering'),
+                              steering, throttle, telemetry['speed'],
+                              decode_time, telemetry.get('preprocess_time'),
+                              telemetry.get('predict_time'), send_time, total_time)
+
     def on_connect(self, sid, environ):
         print("connect ", sid)
+        self.get_session(sid)
         for cb in self.callbacks:
             cb.handle_connect(sid)
-        self.send_control(0, 0)
+        self.send_control(0, 0, sid)
+
+    def on_disconnect(self, sid):
+        print("disconnect ", sid)
+        self.sessions.pop(sid, None)
+        for cb in self.callbacks:
+            if hasattr(cb, 'handle_disconnect'):
+                cb.handle_disconnect(sid)
 
-    def send_control(self, steering_angle, throttle):
-        self.sio.emit("steer", data={
+    def emit_steer(self, data, sid):
+        if sid is None:
+            self.sio.emit("steer", data=data, skip_sid=True)
+        else:
+            self.sio.emit("steer", data=data, room=sid)
+
+    def send_control(self, steering_angle, throttle, sid=None):
+        """
+        Sends controls to the simulator session sid, or to every connected
+        simulator if sid is None.
+        """
+        data = {
             'steering_angle': steering_angle.__str__(),
             'throttle': throttle.__str__()
-        }, skip_sid=True)
+        }
+        t0 = time.perf_counter()
+        self.emit_steer(data, sid)
+        send_time = time.perf_counter() - t0
+        self.metrics.observe('send_control', send_time)
+
+        session = self.sessions.get(sid)
+        if session is not None:
+            session.last_control = (steering_angle, throttle, send_time)
+        if session is not None and session.frame_received_time is not None:
+            age = time.time() - session.frame_received_time
+            session.last_frame_age = self.last_frame_age = age
+            self.max_frame_age = max(self.max_frame_age, age)
+            self.metrics.observe('frame_age', age)
+            self.metrics.increment('frames_steered')
+
+
+def create_server(backend='eventlet', **options):
+    """
+    Returns a control server for the given backend:
+
+    'eventlet' : ControlServer, everything runs in greenthreads
+    'asyncio'  : AsyncControlServer (async_server.py), decoding and callbacks
+                 run in executors
+    """
+    if backend == 'eventlet':
+        return ControlServer(**options)
+    elif backend == 'asyncio':
+        from async_server import AsyncControlServer
+        return AsyncControlServer(**options)
+    raise ValueError('Unknown server backend: %s' % backend)
+
+
+def add_backend_arguments(parser):
+    parser.add_argument('--backend', choices=['eventlet', 'asyncio'], default='eventlet',
+        help='Serve the simulator with eventlet, or with asyncio and a decode pool (async_server.py).')
+    parser.add_argument('--decode-executor', choices=['thread', 'process'], default='thread',
+        help='With --backend asyncio, decode frames in a thread pool or in worker processes.')
+    parser.add_argument('--pipeline', action='store_true',
+        help='Decode and preprocess the next frames while the current one is driven (pipeline.py).')
+
+
+def backend_options(args):
+    """
+    create_server options for the flags added by add_backend_arguments.
+    """
+    options = {'backend': args.backend}
+    if args.pipeline:
+        options['pipeline'] = True
+    if args.backend == 'asyncio':
+        options['decode_executor'] = args.decode_executor
+    return options
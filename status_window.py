@@ -0,0 +1,129 @@
+"""
+Tk status window shared by the drivers
+
+The window is pumped from an eventlet greenthread. Status text is only
+re-rendered when a driver has marked it dirty, and at most `refresh_rate`
+times per second. When there are no Tk events and nothing to render, the pump
+backs off so that it does not compete with telemetry handling.
+
+With headless=True tkinter is never imported and all calls are no-ops, so the
+drivers can run on machines without a display.
+"""
+__author__ = 'Thomas Antony'
+
+import os
+import time
+from platform import system as platform
+
+import eventlet
+
+
+class StatusWindow(object):
+    def __init__(self, title, render, bindings, headless=False,
+                 refresh_rate=10., min_poll=0.01, max_poll=0.1, metrics=None):
+        """
+        title        : window title
+        render       : render() -> status text
+        bindings     : list of (Tk event sequence, handler(event))
+        refresh_rate : maximum number of status renders per second
+        min_poll     : seconds between Tk pumps while there is activity
+        max_poll     : seconds between Tk pumps when idle
+        metrics      : optional Metrics that the time of each status redraw
+                       is recorded in as 'ui_update'
+        """
+        self.title = title
+        self.render = render
+        self.bindings = bindings
+        self.headless = headless
+        self.refresh_interval = 1./refresh_rate
+        self.min_poll = min_poll
+        self.max_poll = max_poll
+        self.metrics = metrics
+
+        self.root = None
+        self.dirty = True
+        self.last_render = 0.
+        self.renders = 0
+
+    def open(self):
+        if self.headless:
+            return
+        import tkinter
+        self.tkinter = tkinter
+
+        # Create the root window
+        self.root = tkinter.Tk()
+        self.root.geometry('350x75+490+550')
+        self.root.title(self.title)
+
+        # Create a label with status
+        self.status = tkinter.StringVar()
+        label = tkinter.Label(self.root, width=350, height=75,
+                              textvariable=self.status)
+        label.pack(fill=tkinter.BOTH, expand=1)
+
+        # Bind key event handlers
+        for sequence, handler in self.bindings:
+            self.root.bind(sequence, handler)
+
+        self.refresh()
+
+        # Start UI loop
+        eventlet.spawn_after(1, self.main_loop)
+
+    def invalidate(self):
+        """
+        Marks the status text as out of date. Cheap enough to call per frame.
+        """
+        self.dirty = True
+
+    def refresh(self):
+        if self.root is None or not self.dirty:
+            return
+        self.dirty = False
+        self.status.set(self.render())
+        self.last_render = time.time()
+        self.renders += 1
+
+    def focus(self):
+        if self.root is None:
+            return
+        self.root.focus_force()
+
+        # OSX code for focusing window
+        if platform() == 'Darwin':
+            os.system('''/usr/bin/osascript -e 'tell app "Finder" to set frontmost of process "python" to true' ''')
+
+    def close(self):
+        if self.root is not None:
+            self.root.destroy()
+            self.root = None
+
+    def pump(self):
+        """
+        Processes pending Tk events without blocking. Returns the number of
+        events handled.
+        """
+        handled = 0
+        while self.root is not None and self.root.tk.dooneevent(self.tkinter._tkinter.DONT_WAIT):
+            handled += 1
+        return handled
+
+    def main_loop(self):
+        self.focus()
+        poll = self.min_poll
+        while self.root is not None:
+            try:
+                active = self.pump() > 0 or self.dirty
+                if self.dirty and time.time() - self.last_render >= self.refresh_interval:
+                    t0 = time.perf_counter()
+                    self.refresh()
+                    self.root.update_idletasks()
+                    if self.metrics is not None:
+                        self.metrics.observe('ui_update', time.perf_counter() - t0)
+            except self.tkinter.TclError:
+                break # Window was closed
+
+            # Poll quickly while things are happening, back off when idle
+            poll = self.min_poll if active else min(2*poll, self.max_poll)
+            eventlet.sleep(poll)
@@ -0,0 +1,144 @@
+"""
+Recording of raw simulator telemetry
+
+A telemetry log is a header followed by one record per frame:
+
+    float64 time received, float32 steering angle, float32 throttle,
+    float32 speed, uint32 image length, image bytes
+
+The image is the base64 JPEG string exactly as the simulator sent it, so
+recording costs no decoding on the hub and replaying a log reproduces the
+original telemetry events. Logs of the first version (SDCTLM1) hold the
+base64-decoded JPEG bytes instead and can still be read.
+"""
+__author__ = 'Thomas Antony'
+
+import os
+import base64
+import struct
+
+magic = b'SDCTLM2\n'
+jpeg_magic = b'SDCTLM1\n' # First version, decoded JPEG bytes
+record_header = struct.Struct('<dfffI')
+
+
+class TelemetryRecorder(object):
+    def __init__(self, path, buffer_size=1 << 20):
+        self.file = open(path, 'wb', buffering=buffer_size)
+        self.file.write(magic)
+        self.frames = 0
+
+    def record(self, data, received):
+        """
+        data     : raw telemetry event as received from the simulator
+        received : time.time() when the event arrived
+        """
+        image = data['image']
+        if not isinstance(image, bytes):
+            image = image.encode('ascii')
+        self.file.write(record_header.pack(received,
+                                           float(data['steering_angle']),
+                                           float(data['throttle']),
+                                           float(data['speed']),
+                                           len(image)))
+        self.file.write(image)
+        self.frames += 1
+
+    def close(self):
+        self.file.close()
+
+
+def read_raw_record(f):
+    """
+    Returns (time received, steering angle, throttle, speed, image bytes) of
+    the record at the current position of f, or None at the end of the log.
+    """
+    header = f.read(record_header.size)
+    if len(header) < record_header.size:
+        return None
+    received, steering_angle, throttle, speed, length = record_header.unpack(header)
+    image = f.read(length)
+    if len(image) < length:
+        return None # Truncated by a crash during recording
+    return received, steering_angle, throttle, speed, image
+
+
+def read_record(f, encoded=True):
+    """
+    Like read_raw_record, with the image as JPEG bytes.
+
+    encoded : whether the log stores base64 images, see open_log
+    """
+    record = read_raw_record(f)
+    if record is None or not encoded:
+        return record
+    return record[:4] + (base64.b64decode(record[4]),)
+
+
+def open_log(path):
+    """
+    Returns the open log and whether its images are base64 encoded.
+    """
+    f = open(path, 'rb')
+    header = f.read(len(magic))
+    if header not in (magic, jpeg_magic):
+        f.close()
+        raise ValueError('%s is not a telemetry log' % path)
+    return f, header == magic
+
+
+def read_telemetry_log(path):
+    """
+    Yields (time received, telemetry event) for every frame in the log. The
+    events have the same layout that the simulator sends.
+    """
+    f, encoded = open_log(path)
+    with f:
+        while True:
+            record = read_raw_record(f)
+            if record is None:
+                return
+            received, steering_angle, throttle, speed, image = record
+            if not encoded:
+                image = base64.b64encode(image)
+            yield received, {'steering_angle': repr(steering_angle),
+                             'throttle': repr(throttle),
+                             'speed': repr(speed),
+                             'image': image.decode('ascii')}
+
+
+def index_telemetry_log(path):
+    """
+    Returns the file offsets of all complete records in the log, without
+    reading the images.
+    """
+    offsets = []
+    f, encoded = open_log(path)
+    with f:
+        size = os.fstat(f.fileno()).st_size
+        while True:
+            offset = f.tell()
+            header = f.read(record_header.size)
+            if len(header) < record_header.size:
+                break
+            length = record_header.unpack(header)[-1]
+            if offset + record_header.size + length > size:
+                break # Truncated record
+            offsets.append(offset)
+            f.seek(length, os.SEEK_CUR)
+    return offsets
+
+
+def read_telemetry_records(path, offset, count):
+    """
+    Yields up to count records (see read_record) starting at a file offset
+    returned by index_telemetry_log.
+    """
+    f, encoded = open_log(path)
+    with f:
+        f.seek(offset)
+        for i in range(count):
+            record = read_record(f, encoded)
+            if record is None:
+                return
+            yield record
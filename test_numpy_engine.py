@@ -0,0 +1,170 @@
+"""
+Tests of numpy_engine.py against a naive NumPy reference
+
+The layers are checked on small random weights, so neither Keras nor
+TensorFlow is needed. test_keras_comparison also runs a small model in Keras
+and is skipped unless Keras 1 is installed.
+
+    python -m pytest test_numpy_engine.py
+"""
+__author__ = 'Thomas Antony'
+
+import json
+
+import numpy as np
+import pytest
+
+from numpy_engine import NumpyEngine, Conv2D, Dense, Activation, build_layers
+
+
+def reference_activation(x, name):
+    if name == 'linear':
+        return x
+    if name == 'relu':
+        return np.maximum(x, 0)
+    if name == 'elu':
+        return np.where(x > 0, x, np.exp(x) - 1)
+    raise ValueError(name)
+
+
+def reference_conv(x, W, b, stride, name='linear'):
+    """
+    Valid convolution of x (n, h, w, c) with W (rows, cols, c, filters),
+    one output pixel at a time.
+    """
+    n, h, w, c = x.shape
+    rows, cols, _, filters = W.shape
+    ho = (h - rows)//stride[0] + 1
+    wo = (w - cols)//stride[1] + 1
+    out = np.zeros((n, ho, wo, filters), dtype=np.float64)
+    for i in range(ho):
+        for j in range(wo):
+            window = x[:, i*stride[0]:i*stride[0] + rows, j*stride[1]:j*stride[1] + cols, :]
+            for f in range(filters):
+                out[:, i, j, f] = (window*W[:, :, :, f]).sum(axis=(1, 2, 3)) + b[f]
+    return reference_activation(out, name)
+
+
+def reference_dense(x, W, b, name='linear'):
+    out = np.zeros((x.shape[0], W.shape[1]), dtype=np.float64)
+    for k in range(W.shape[1]):
+        out[:, k] = (x*W[:, k]).sum(axis=1) + b[k]
+    return reference_activation(out, name)
+
+
+def random_weights(rng, *shape):
+    return rng.uniform(-0.5, 0.5, shape).astype(np.float32)
+
+
+@pytest.mark.parametrize('stride', [(1, 1), (2, 2), (2, 1)])
+@pytest.mark.parametrize('name', ['linear', 'relu', 'elu'])
+def test_conv(stride, name):
+    rng = np.random.RandomState(0)
+    x = random_weights(rng, 3, 9, 11, 2)
+    W = random_weights(rng, 3, 4, 2, 5)
+    b = random_weights(rng, 5)
+
+    layer = Conv2D('conv', x.shape[1:], 5, 3, 4, stride, name)
+    layer.set_weights([W, b])
+    layer.allocate(len(x))
+    out = layer.forward(x, len(x))
+
+    expected = reference_conv(x, W, b, stride, name)
+    assert out.shape == expected.shape
+    np.testing.assert_allclose(out, expected, atol=1e-5)
+
+
+@pytest.mark.parametrize('name', ['linear', 'relu', 'elu'])
+def test_dense(name):
+    rng = np.random.RandomState(1)
+    x = random_weights(rng, 4, 7)
+    W = random_weights(rng, 7, 3)
+    b = random_weights(rng, 3)
+
+    layer = Dense('dense', (7,), 3, name)
+    layer.set_weights([W, b])
+    layer.allocate(len(x))
+    np.testing.assert_allclose(layer.forward(x, len(x)), reference_dense(x, W, b, name),
+                               atol=1e-5)
+
+
+@pytest.mark.parametrize('alpha', [1., 0.3])
+def test_elu(alpha):
+    x = np.linspace(-5, 5, 101, dtype=np.float32).reshape(1, -1)
+    expected = np.where(x > 0, x, alpha*(np.exp(x.astype(np.float64)) - 1))
+
+    layer = Activation('elu', x.shape[1:], 'elu', alpha)
+    np.testing.assert_allclose(layer.forward(x.copy(), 1), expected, atol=1e-6)
+
+
+def small_model_config(activation='elu'):
+    """
+    Keras 1 json config of a small model_5-like network.
+    """
+    return [
+        {'class_name': 'Lambda',
+         'config': {'name': 'lambda_1', 'batch_input_shape': [None, 12, 16, 3]}},
+        {'class_name': 'Convolution2D',
+         'config': {'name': 'conv_1', 'nb_filter': 4, 'nb_row': 3, 'nb_col': 3,
+                    'subsample': [2, 2], 'activation': activation,
+                    'border_mode': 'valid', 'dim_ordering': 'tf'}},
+        {'class_name': 'Convolution2D',
+         'config': {'name': 'conv_2', 'nb_filter': 6, 'nb_row': 2, 'nb_col': 3,
+                    'subsample': [1, 1], 'activation': 'linear',
+                    'border_mode': 'valid', 'dim_ordering': 'tf'}},
+        {'class_name': 'ELU', 'config': {'name': 'elu_1', 'alpha': 0.5}},
+        {'class_name': 'Flatten', 'config': {'name': 'flatten_1'}},
+        {'class_name': 'Dense',
+         'config': {'name': 'dense_1', 'output_dim': 8, 'activation': activation}},
+        {'class_name': 'Dropout', 'config': {'name': 'dropout_1', 'p': 0.5}},
+        {'class_name': 'Dense',
+         'config': {'name': 'dense_2', 'output_dim': 1, 'activation': 'linear'}},
+    ]
+
+
+def test_engine():
+    rng = np.random.RandomState(2)
+    weights = [random_weights(rng, 3, 3, 3, 4), random_weights(rng, 4),
+               random_weights(rng, 2, 3, 4, 6), random_weights(rng, 6),
+               random_weights(rng, 4*5*6, 8), random_weights(rng, 8),
+               random_weights(rng, 8, 1), random_weights(rng, 1)]
+    images = rng.randint(0, 256, (5, 12, 16, 3)).astype(np.uint8)
+
+    engine = NumpyEngine(build_layers(small_model_config()))
+    engine.set_weights(weights)
+
+    x = images/127.5 - 1.
+    x = reference_conv(x, weights[0], weights[1], (2, 2), 'elu')
+    x = reference_conv(x, weights[2], weights[3], (1, 1))
+    x = np.where(x > 0, x, 0.5*(np.exp(x) - 1))
+    x = reference_dense(x.reshape(len(x), -1), weights[4], weights[5], 'elu')
+    expected = reference_dense(x, weights[6], weights[7])[:, 0]
+
+    np.testing.assert_allclose(engine.predict_batch(images), expected, atol=1e-5)
+    # Single frames reuse the buffers of the batch
+    for image, y in zip(images, expected):
+        assert abs(engine.predict(image) - y) < 1e-5
+
+
+def test_keras_comparison():
+    keras = pytest.importorskip('keras')
+    if not keras.__version__.startswith('1.'):
+        pytest.skip('the model json layout is that of Keras 1')
+    from keras.models import Sequential
+    from keras.layers import Lambda, Convolution2D, Flatten, Dense as KerasDense, ELU
+
+    model = Sequential()
+    model.add(Lambda(lambda x: x/127.5 - 1., input_shape=(12, 16, 3)))
+    model.add(Convolution2D(4, 3, 3, subsample=(2, 2), activation='elu'))
+    model.add(Convolution2D(6, 2, 3, activation='relu'))
+    model.add(ELU(alpha=0.5))
+    model.add(Flatten())
+    model.add(KerasDense(8, activation='elu'))
+    model.add(KerasDense(1))
+
+    engine = NumpyEngine(build_layers(json.loads(model.to_json())['config']))
+    engine.set_weights(model.get_weights())
+
+    images = np.random.RandomState(3).randint(0, 256, (5, 12, 16, 3)).astype(np.uint8)
+    expected = model.predict(images.astype(np.float32))[:, 0]
+    np.testing.assert_allclose(engine.predict_batch(images), expected, atol=1e-4)
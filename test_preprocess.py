@@ -0,0 +1,84 @@
+"""
+Tests that both decode modes give the model the same input
+
+The PIL decode path hands preprocess_input float32 frames and --fast-decode
+hands it uint8 frames. The steering must not depend on the flag.
+
+    python -m pytest test_preprocess.py
+"""
+__author__ = 'Thomas Antony'
+
+import json
+
+import cv2
+import numpy as np
+import pytest
+
+import drive
+from server import decode_frame
+from fake_sim import synthetic_frames
+from hybrid_driver import HybridDriver
+from live_trainer import LiveTrainer
+from numpy_engine import NumpyEngine, build_layers
+
+
+def baseline_preprocess(img):
+    """
+    model_5 preprocessing of the float32 PIL frames, as originally trained.
+    """
+    return cv2.resize(cv2.cvtColor(img, cv2.COLOR_RGB2YUV)[60:140, 40:280], (200, 66))
+
+
+def random_engine(seed=0):
+    """
+    model_5 with small random weights.
+    """
+    with open('model_5.json', 'r') as jfile:
+        engine = NumpyEngine(build_layers(json.load(jfile)['config']))
+    rng = np.random.RandomState(seed)
+    weights = []
+    shape = engine.input_shape
+    for layer in engine.layers:
+        if layer.n_weights:
+            fan_in = int(np.prod(shape if len(layer.output_shape) == 1
+                                 else layer.kernel + shape[-1:]))
+            units = layer.output_shape[-1]
+            weights.append(rng.normal(0, 1/np.sqrt(fan_in), (fan_in, units)).astype(np.float32))
+            weights.append(rng.normal(0, 0.1, units).astype(np.float32))
+        shape = layer.output_shape
+    engine.set_weights(weights)
+    return engine
+
+
+preprocessors = {
+    'drive': drive.preprocess_input,
+    'hybrid': HybridDriver.__new__(HybridDriver).preprocess_input,
+    'trainer': LiveTrainer.preprocess_input,
+}
+
+
+@pytest.fixture(scope='module')
+def images():
+    frames = synthetic_frames(10)
+    return dict((mode, [decode_frame(data, mode)[0]['image'] for data in frames])
+                for mode in ('pil', 'fast'))
+
+
+@pytest.mark.parametrize('name', sorted(preprocessors))
+@pytest.mark.parametrize('mode', ['pil', 'fast'])
+def test_same_input(images, name, mode):
+    preprocess = preprocessors[name]
+    for img, reference in zip(images[mode], images['pil']):
+        x = preprocess(img)
+        assert x.dtype == np.float32
+        np.testing.assert_allclose(x, baseline_preprocess(reference), atol=1e-3)
+
+
+def test_same_steering(images):
+    engine = random_engine()
+    y = {}
+    for mode in ('pil', 'fast'):
+        y[mode] = engine.predict_batch(np.stack([LiveTrainer.preprocess_input(img)
+                                                 for img in images[mode]]))
+    assert np.abs(y['pil']).max() > 1e-3
+    np.testing.assert_allclose(y['fast'], y['pil'], atol=1e-4)
@@ -0,0 +1,40 @@
+"""
+Tests of replay_memory.py
+
+    python -m pytest test_replay_memory.py
+"""
+__author__ = 'Thomas Antony'
+
+import numpy as np
+import pytest
+
+from server import decode_frame
+from fake_sim import synthetic_frames
+from live_trainer import LiveTrainer
+from replay_memory import ReplayMemory
+
+
+def test_round_trip():
+    frames = synthetic_frames(5)
+    images = [LiveTrainer.preprocess_input(decode_frame(data, 'pil')[0]['image'])
+              for data in frames]
+    assert min(x.min() for x in images) < 0 # U/V of the YUV frames
+
+    memory = ReplayMemory(3)
+    for i, x in enumerate(images):
+        memory.add(x, i*0.1)
+
+    X, y = memory.latest(3)
+    assert X.dtype == images[0].dtype
+    np.testing.assert_array_equal(X, np.stack(images[-3:]))
+    np.testing.assert_allclose(y, [0.2, 0.3, 0.4])
+
+    X, y = memory.sample(8, fresh=2)
+    assert len(X) == 3
+    np.testing.assert_array_equal(X[:2], np.stack(images[-2:]))
+
+
+def test_no_lossy_cast():
+    memory = ReplayMemory(2, image_shape=(2, 2, 3), dtype=np.uint8)
+    with pytest.raises(TypeError):
+        memory.add(np.full((2, 2, 3), -37., dtype=np.float32), 0.)
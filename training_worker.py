@@ -0,0 +1,134 @@
+"""
+Background training worker for the live trainer
+
+Batches collected while driving are queued here and trained on a shadow copy
+of the model in a separate OS thread, so that `model.fit` never runs on the
+eventlet loop that answers the simulator. Updated weights are handed back to
+the inference model with `apply_updates()`, which the telemetry handler calls
+between frames.
+"""
+__author__ = 'Thomas Antony'
+
+import time
+import queue
+import threading
+
+import tensorflow as tf
+from keras.models import model_from_json
+
+
+class TrainingWorker(object):
+    def __init__(self, model, optimizer, train_fn, loss='mse', max_queue=4,
+                 metrics=None):
+        """
+        model     : Keras model used for inference (never trained directly)
+        optimizer : Keras optimizer instance for the shadow model
+        train_fn  : train_fn(model, X, y) -> loss, called in the worker thread
+        max_queue : number of pending batches kept before the oldest is dropped
+        metrics   : optional Metrics that training and swap times are recorded in
+        """
+        self.model = model
+        self.train_fn = train_fn
+        self.metrics = metrics
+
+        # Shadow copy that is trained off the telemetry path
+        self.graph = tf.get_default_graph()
+        self.shadow = model_from_json(model.to_json())
+        self.shadow.compile(optimizer, loss)
+        self.shadow.set_weights(model.get_weights())
+
+        self.batches = queue.Queue(maxsize=max_queue)
+        self.lock = threading.Lock()
+        self.pending_weights = None
+
+        # Statistics
+        self.trained_batches = 0
+        self.dropped_batches = 0
+        self.swapped_updates = 0
+        self.last_loss = None
+
+        self.thread = threading.Thread(target=self.run, name='training-worker')
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    @property
+    def queue_depth(self):
+        return self.batches.qsize()
+
+    def submit(self, X, y):
+        """
+        Queue a batch for training. Never blocks: if the queue is full the
+        oldest pending batch is discarded in favour of the new one.
+        """
+        while True:
+            try:
+                self.batches.put_nowait((X, y))
+                return
+            except queue.Full:
+                try:
+                    self.batches.get_nowait()
+                    self.dropped_batches += 1
+                    if self.metrics is not None:
+                        self.metrics.increment('batches_dropped')
+                except queue.Empty:
+                    pass
+
+    def stop(self):
+        """
+        Discards the pending batches and waits for the batch being trained.
+        The shadow model then holds the final weights.
+        """
+        while True:
+            try:
+                self.batches.get_nowait()
+            except queue.Empty:
+                break
+        while True:
+            try:
+                self.batches.put_nowait(None)
+                break
+            except queue.Full:
+                try:
+                    self.batches.get_nowait()
+                except queue.Empty:
+                    pass
+        self.thread.join()
+
+    def run(self):
+        with self.graph.as_default():
+            while True:
+                batch = self.batches.get()
+                if batch is None:
+                    break
+                X, y = batch
+                t0 = time.perf_counter()
+                self.last_loss = self.train_fn(self.shadow, X, y)
+                weights = self.shadow.get_weights()
+                if self.metrics is not None:
+                    self.metrics.observe('train_step', time.perf_counter() - t0)
+                    self.metrics.increment('batches_trained')
+                with self.lock:
+                    self.pending_weights = weights
+                self.trained_batches += 1
+
+    def apply_updates(self, engine=None):
+        """
+        Copies the latest trained weights into the inference model, or with
+        set_weights() into engine if given. Call this from the telemetry
+        handler between frames. Returns True if the weights were updated.
+        """
+        with self.lock:
+            weights = self.pending_weights
+            self.pending_weights = None
+
+        if weights is None:
+            return False
+
+        t0 = time.perf_counter()
+        (engine or self.model).set_weights(weights)
+        self.swapped_updates += 1
+        if self.metrics is not None:
+            self.metrics.observe('weight_swap', time.perf_counter() - t0)
+        return True
@@ -0,0 +1,122 @@
+"""
+Hot reload of model weights from a checkpoint file
+
+`WeightWatcher` polls a weights file (e.g. the `checkpoint.h5` written by the
+live trainer) from a background thread. When the file changes it is read with
+h5py in that thread and checked against the expected weight shapes. The new
+weights are then held until the driver calls `take()` between two frames and
+swaps them into its model, so loading never blocks telemetry handling.
+"""
+__author__ = 'Thomas Antony'
+
+import os
+import time
+import threading
+
+import h5py
+
+
+def decode(name):
+    return name.decode('utf8') if isinstance(name, bytes) else name
+
+
+def read_layer_weights(path):
+    """
+    Returns [(layer name, [weight arrays]), ...] as stored by Keras'
+    save_weights (or save).
+    """
+    with h5py.File(path, 'r') as f:
+        if 'model_weights' in f:
+            f = f['model_weights'] # Written by model.save
+        layers = []
+        for layer_name in f.attrs['layer_names']:
+            g = f[decode(layer_name)]
+            layers.append((decode(layer_name),
+                           [g[decode(name)][()] for name in g.attrs['weight_names']]))
+    return layers
+
+
+def read_weights(path):
+    """
+    Returns the weights as a flat list of arrays, in the order of
+    model.get_weights().
+    """
+    return [w for name, weights in read_layer_weights(path) for w in weights]
+
+
+def weight_shapes(path):
+    return [w.shape for w in read_weights(path)]
+
+
+class WeightWatcher(object):
+    def __init__(self, path, shapes, poll_interval=1.):
+        """
+        path          : weights file to watch
+        shapes        : expected shapes of the weights, in get_weights() order
+        poll_interval : seconds between checks of the file
+        """
+        self.path = path
+        self.shapes = [tuple(shape) for shape in shapes]
+        self.poll_interval = poll_interval
+
+        self.lock = threading.Lock()
+        self.pending = None
+        self.last_stamp = None
+
+        # Statistics
+        self.loads = 0
+        self.rejected = 0
+
+        self.thread = threading.Thread(target=self.run, name='weight-watcher')
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stamp(self):
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return None
+        return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+    def check(self):
+        """
+        Loads the file if it changed since the last successful check.
+        """
+        stamp = self.stamp()
+        if stamp is None or stamp == self.last_stamp:
+            return
+
+        try:
+            weights = read_weights(self.path)
+        except Exception as e:
+            print('Could not read %s, retrying: %s' % (self.path, e))
+            return # Probably still being written
+        self.last_stamp = stamp
+
+        shapes = [w.shape for w in weights]
+        if shapes != self.shapes:
+            self.rejected += 1
+            print('Ignoring %s, weight shapes do not match the model' % self.path)
+            return
+
+        with self.lock:
+            self.pending = weights
+        self.loads += 1
+
+    def run(self):
+        while True:
+            self.check()
+            time.sleep(self.poll_interval)
+
+    def take(self):
+        """
+        Returns newly loaded weights, or None if there are none. Each set of
+        weights is returned once.
+        """
+        with self.lock:
+            weights = self.pending
+            self.pending = None
+        return weights